@@ -1,112 +1,260 @@
 import os
+import sys
+import json
 import time
 import datetime
+import subprocess
 import sqlite3
-import pandas as pd
 import yfinance as yf
-import requests
+import threading
 import duckdb  
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from util.database_duckdb import (DB_PATH, BatchWriteError, StockWriter, compact_stock_data, get_last_dates,
+                                  migrate_ticker_tables)
+from util.sharding import (STAGING_DIR, create_staging_tables, export_last_dates, load_last_dates,
+                           merge_staging, record_bounds, shard_config, shard_tickers, staging_path)
+from util import yahoo_client
+from util.chart_parser import parse_chart
+from util.failure_registry import FailureRegistry
+from util.job_state import DownloadJob
+from util.universe import plan_universe
+from util.yahoo_client import configure_session, fetch_chart_raw
 
 # 1. 数据库配置
-DB_PATH = "yahoo_stock_data.duckdb"
+# 分片模式 (SHARD_COUNT > 1)：本进程只处理哈希落在 SHARD_INDEX 的股票，写入自己的 staging 文件，
+# 主库只由合并步骤写入，多个进程/Pod 可以同时跑
+SHARD_INDEX, SHARD_COUNT = shard_config()
+if SHARD_COUNT > 1:
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    con = duckdb.connect(staging_path(SHARD_INDEX, SHARD_COUNT))
+    create_staging_tables(con)
+else:
+    con = duckdb.connect(DB_PATH)
+    # 所有股票存放在同一张长表 stock_data 中；旧版单股票表在首次运行时自动迁移
+    migrate_ticker_tables(con)
 
-con = duckdb.connect(DB_PATH)
+# 并发下载配置：线程数 与 全局每秒请求数 (所有线程共享；本机多进程时由父进程平分)
+MAX_WORKERS = 8
+REQUESTS_PER_SECOND = float(os.getenv("YAHOO_RPS", 3.0))
+
+# 批量入库配置：每 N 只股票 / 每 T 秒 / 缓冲超过内存上限 (MB) 时整批写入一次
+# 写入前整批对齐到自然月月末 (与 redownload.py 相同的规则)
+FLUSH_TICKERS = 200
+FLUSH_SECONDS = 30
+FLUSH_MAX_MB = 256
+writer = StockWriter(con, FLUSH_TICKERS, FLUSH_SECONDS, FLUSH_MAX_MB, month_end=True)
+if SHARD_COUNT > 1:
+    # 记录每只股票的替换范围，合并时按同样的规则删除主库旧数据
+    STAGING_HOOKS = [lambda tickers: record_bounds(con, {t: writer.since[t] for t in tickers})]
+else:
+    STAGING_HOOKS = []
+
+# 下载范围：剔除未启用/已退市后按得分排序 (star、指数成分、多久没更新)；UNIVERSE_LIMIT 限制每个市场最多下载的只数
+UNIVERSE_WEIGHTS = {'star': 1.0, 'index': 1.0, 'staleness': 2.0}
+UNIVERSE_LIMIT = None
+
+# 失败登记表：失败原因/次数/下次可重试时间，redownload.py 从中取重试队列
+registry = FailureRegistry()
 
 # 2. 数据库入库核心逻辑
-def save_to_duckdb(df, ticker):
-    """统一处理 DuckDB 入库，解决数字表名和主键冲突问题"""
+def save_to_duckdb(df, ticker, market, since=None, source=None):
+    """统一处理 DuckDB 入库：先放入批量缓冲区，攒够一批后在一个事务里写入 stock_data 长表
+    since: 增量模式下本次抓取的起始日期，只替换 date >= since 的行，其余历史保持不动
+    source: 数据来源 (yf / API)，与首末日期、行数、内容哈希一起记入 ticker_meta
+    没有数据时返回 False；入库失败时打印并抛出原异常，由调用方按入库失败登记"""
     if df is None or df.empty:
         return False
     
     try:
-        table_name = ticker.lower().replace('.', '_').replace('-', '_')
-        con.register('df_view', df)
-        table_check = con.execute(f"SELECT count(*) FROM information_schema.tables WHERE table_name = '{table_name}'").fetchone()[0]
-        
-        if not table_check:
-            con.execute(f'CREATE TABLE "{table_name}" AS SELECT * FROM df_view')
-        else:
-            con.execute(f'DELETE FROM "{table_name}"')
-            con.execute(f'INSERT INTO "{table_name}" SELECT * FROM df_view')
-            
-        con.unregister('df_view')
+        writer.add(df, ticker, market, since, source)
         return True
+    except BatchWriteError:
+        raise
     except Exception as e:
         print(f"   ❌ DuckDB 入库失败 [{ticker}]: {e}")
-        return False
+        raise
+
+def record_success(tickers):
+    """提交时把成功的股票移出失败登记表；增量抓取 (since 非空) 的股票保留 QC 登记的 data_odd 记录，留给 redownload 全量重下"""
+    registry.record_success(tickers, partial=[t for t in tickers if writer.since.get(t) is not None])
+
+def record_batch_failure(batch, error):
+    """整批入库失败时把批内股票全部登记为入库失败 ({ticker: market})，不计入 dead 判定"""
+    registry.record_failures([(ticker, market, error) for ticker, market in batch.items()], error_class='storage')
+
+def get_stored_last_dates(ticker_list=None):
+    """一次查询取出已入库股票的最新日期 {ticker: date}；分片进程读取父进程导出的快照或只读打开主库"""
+    if SHARD_COUNT > 1:
+        last_dates = load_last_dates(con)
+        if last_dates is None:
+            # 没有父进程导出的快照 (例如独立的 Pod)：只读打开主库
+            try:
+                with duckdb.connect(DB_PATH, read_only=True) as main_con:
+                    last_dates = get_last_dates(main_con, ticker_list)
+            except duckdb.Error as e:
+                print(f"⚠️ 无法读取主库最新日期，按全量处理: {e}")
+                last_dates = {}
+        if ticker_list is not None:
+            wanted = set(ticker_list)
+            last_dates = {t: d for t, d in last_dates.items() if t in wanted}
+        return last_dates
+    return get_last_dates(con, ticker_list)
+
+def get_since_dates(ticker_list):
+    """增量模式：返回已入库股票的 {ticker: 最新日期所在月的1号}
+    从最新一条所在月的月初重新抓取，保证当月未收盘的 K 线会被新数据覆盖"""
+    return {ticker: last_date.strftime('%Y-%m-01')
+            for ticker, last_date in get_stored_last_dates(ticker_list).items()}
+
+def flush_writer():
+    """把缓冲区剩余的数据写入数据库"""
+    try:
+        count = writer.flush()
+        if count:
+            print(f"💾 批量入库 {count} 只股票")
+    except Exception as e:
+        print(f"   ❌ DuckDB 批量入库失败: {e}")
 
 # 3. Requests 抓取逻辑
-def download_via_requests(ticker, start_date, end_date):
-    """API 模式下载"""
+def fetch_via_requests(ticker, start_date, end_date):
+    """API 模式抓取，只负责网络请求与解析，返回 DataFrame 或 None"""
+    start_unix = int(time.mktime(time.strptime(start_date, "%Y-%m-%d")))
+    end_unix = int(time.mktime(time.strptime(end_date, "%Y-%m-%d")))
+
+    # 共享连接池的 Session，非 200 状态码会抛出 YahooHTTPError；原始字节直接解析成带类型的列
+    df = parse_chart(fetch_chart_raw(ticker, start_unix, end_unix, interval='1mo', timeout=15))
+    df = df.dropna(subset=['close'])
+    return df if not df.empty else None
+
+def fetch_via_yfinance(ticker, start_date, end_date):
+    """yfinance 模式抓取，返回 DataFrame 或 None
+    注意：yf.download 内部使用全局字典暂存结果，多线程下会串数据，这里用 Ticker.history"""
+    df = yf.Ticker(ticker).history(start=start_date, end=end_date, interval='1mo',
+                                   auto_adjust=False, actions=False, timeout=10)
+    if df is None or df.empty:
+        return None
+    # 清洗 yfinance 特有的列名
+    df.columns = [c.lower().replace(' ', '_') for c in df.columns]
+    # 重置索引，把 Date 变成普通列
+    df = df.reset_index()
+    df.columns = [c.lower() for c in df.columns]
+    return df
+
+# 4. 核心下载控制
+class RateLimiter:
+    """令牌桶限速器：所有线程共享同一个每秒请求预算"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def fetch_ticker(ticker, start_date, end_date, method_choice, limiter=None):
+    """按 method_choice 依次尝试 yfinance / requests，返回 (df, 来源, 最后一次错误)；每次网络请求前先取令牌"""
+    error = None
+    # yfinance (离线回放模式下 yfinance 无法走缓存，直接跳过)
+    if method_choice in [0, 1] and not yahoo_client.OFFLINE:
+        try:
+            if limiter:
+                limiter.acquire()
+            df = fetch_via_yfinance(ticker, start_date, end_date)
+            if df is not None:
+                return df, 'yf', None
+        except Exception as e:
+            error = e
+            print(f"   ❌ yfinance 失败 [{ticker}]: {e}")
+
+    # Requests
+    if method_choice in [0, 2]:
+        try:
+            if limiter:
+                limiter.acquire()
+            df = fetch_via_requests(ticker, start_date, end_date)
+            if df is not None:
+                return df, 'API', None
+        except Exception as e:
+            error = e
+            print(f"   ❌ Requests 失败 [{ticker}]: {e}")
+    return None, None, error
+
+def handle_result(ticker, market, result, since=None, job=None, progress=''):
+    """入库并记录任务状态；成功的股票在批量写入提交时才标记为 done"""
+    df, source, error = result
+    error_class = None
     try:
-        start_unix = int(time.mktime(time.strptime(start_date, "%Y-%m-%d")))
-        end_unix = int(time.mktime(time.strptime(end_date, "%Y-%m-%d")))
-        
-        url = f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}?period1={start_unix}&period2={end_unix}&interval=1mo"
-        headers = {"User-Agent": "Mozilla/5.0"}
-        
-        response = requests.get(url, headers=headers, timeout=15)
-        if response.status_code == 200:
-            result = response.json()
-            chart = result.get("chart", {}).get("result", [None])[0]
-            if chart and "timestamp" in chart:
-                ts = chart.get("timestamp", [])
-                indicators = chart.get("indicators", {})
-                quote = indicators.get("quote", [{}])[0]
-                adj = indicators.get("adjclose", [{}])[0].get("adjclose", [])
-                
-                df = pd.DataFrame({
-                    "date": pd.to_datetime(ts, unit='s'),
-                    "open": quote.get("open", []),
-                    "high": quote.get("high", []),
-                    "low": quote.get("low", []),
-                    "close": quote.get("close", []),
-                    "adj_close": adj,
-                    "volume": quote.get("volume", [])
-                }).dropna(subset=['close'])
-                
-                # 统一列名格式
-                df.columns = [c.lower() for c in df.columns]
-                return save_to_duckdb(df, ticker)
+        saved = df is not None and save_to_duckdb(df, ticker, market, since, source)
+    except BatchWriteError as e:
+        # 本股票触发的整批写入失败：整批已丢弃，批内股票 (含本股票) 已由 on_failure 钩子记为失败
+        print(f"❌ {ticker} 失败{progress}: {e}")
+        return False
     except Exception as e:
-        print(f"   ❌ Requests 失败 [{ticker}]: {e}")
+        # 下载成功但入库失败：按 storage 登记，不会把正常的股票标记为 dead
+        saved, error, error_class = False, e, 'storage'
+    if saved:
+        print(f"✅ {source} 成功: {ticker}{progress}")
+        return True
+    print(f"❌ {ticker} 失败{progress}")
+    registry.record_failure(ticker, market, error, error_class)
+    if job:
+        job.mark_failed(ticker, error or "无数据")
     return False
 
-# 4. 核心下载控制
-def download_chunk(ticker_list, start_date, end_date, method_choice):
+def download_chunk(ticker_list, market, start_date, end_date, method_choice, since_dates=None, job=None):
     """单线程循环处理，防封防锁"""
+    since_dates = since_dates or {}
     for ticker in ticker_list:
         try:
-            success = False
-            # yfinance
-            if method_choice in [0, 1]:
-                df = yf.download(ticker, start=start_date, end=end_date, 
-                                 interval='1mo', progress=False, timeout=10)
-                if not df.empty:
-                    # 清洗 yfinance 特有的列名
-                    df.columns = [c.lower().replace(' ', '_') for c in df.columns]
-                    # 重置索引，把 Date 变成普通列
-                    df = df.reset_index()
-                    df.columns = [c.lower() for c in df.columns]
-                    
-                    if save_to_duckdb(df, ticker):
-                        print(f"✅ yf 成功: {ticker}")
-                        success = True
-            
-            # Requests
-            if not success and method_choice in [0, 2]:
-                if download_via_requests(ticker, start_date, end_date):
-                    print(f"✅ API 成功: {ticker}")
-                else:
-                    print(f"❌ {ticker} 失败")
-            
-            time.sleep(0.6)
-            
+            since = since_dates.get(ticker)
+            result = fetch_ticker(ticker, since or start_date, end_date, method_choice)
+            handle_result(ticker, market, result, since, job)
+
+            if not yahoo_client.OFFLINE:
+                time.sleep(0.6)
+
         except Exception as e:
             print(f"⚠️ 处理 {ticker} 时出错: {e}")
 
+def download_concurrent(ticker_list, market, start_date, end_date, method_choice, since_dates=None, job=None,
+                        max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND):
+    """线程池并发下载：网络请求并行，受全局令牌桶限速；入库统一在主线程串行执行 (DuckDB 连接不可跨线程共享)"""
+    since_dates = since_dates or {}
+    # 连接池大小与线程数一致，每个线程都能复用 keep-alive 连接
+    configure_session(pool_size=max_workers)
+    # 离线回放只读本地缓存，不需要限速
+    limiter = None if yahoo_client.OFFLINE else RateLimiter(requests_per_second)
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fetch_ticker, ticker, since_dates.get(ticker, start_date), end_date,
+                               method_choice, limiter): ticker
+                   for ticker in ticker_list}
+        for future in as_completed(futures):
+            ticker = futures[future]
+            done += 1
+            try:
+                handle_result(ticker, market, future.result(), since_dates.get(ticker), job,
+                              f" ({done}/{len(futures)})")
+            except Exception as e:
+                print(f"⚠️ 处理 {ticker} 时出错: {e}")
+
 # 5. 主程序
-def download_main(market_option, method_option):
+def download_main(market_option, method_option, download_mode='concurrent', incremental=False, resume=True):
+    """download_mode: 'sequential' 单线程逐只下载; 'concurrent' 线程池并发 + 全局限速
+    incremental: True 时只抓取每只股票库中最新日期之后的数据 (新股票仍从 1970 年开始)
+    resume: True 时续上参数相同、尚未完成的上一次运行，只处理其中未成功的股票"""
     market_map = {1: 'Shanghai_Shenzhen', 2: 'Snp500_Ru1000', 3: 'TSX'}
     start_date = "1970-01-01"
     end_date = datetime.datetime.now().strftime('%Y-%m-%d')
@@ -118,21 +266,97 @@ def download_main(market_option, method_option):
     conn_local = sqlite3.connect('yahoo_data.db')
     targets = market_map.values() if market_option == 0 else [market_map.get(market_option)]
     
-    print(f"🚀 启动下载 [模式 {method_option}]...")
+    print(f"🚀 启动下载 [模式 {method_option} / {download_mode}{' / 增量' if incremental else ''}]...")
+
+    # 断点续传：每只股票的状态与数据在同一事务中提交；参数含目标月份，上个月没跑完的任务不会被本月续上
+    job = DownloadJob.start(con, {'markets': list(targets), 'method': method_option, 'incremental': incremental,
+                                  'shard': [SHARD_INDEX, SHARD_COUNT], 'target_month': end_date[:7]},
+                            resume=resume)
+    writer.before_commit = STAGING_HOOKS + [job.mark_done, record_success]
+    writer.on_failure = [job.mark_batch_failed, record_batch_failure]
+    stored_last_dates = get_stored_last_dates()
 
     for m_name in targets:
         try:
-            stocks = pd.read_sql(f"SELECT Yahoo_adj_Ticker_symbol FROM {m_name}", conn_local)['Yahoo_adj_Ticker_symbol'].tolist()
-            print(f"正在处理 {m_name}，共 {len(stocks)} 只股票...")
-            download_chunk(stocks, start_date, end_date, method_option)
+            # 请求前先过滤未启用/已退市的股票，并按优先级排序
+            stocks = plan_universe(conn_local, m_name, stored_last_dates, UNIVERSE_WEIGHTS)['ticker'].tolist()
+            if UNIVERSE_LIMIT:
+                stocks = stocks[:UNIVERSE_LIMIT]
+            stocks = shard_tickers(stocks, SHARD_INDEX, SHARD_COUNT)
+            # 多次确认无数据的股票 (dead) 不再请求
+            dead = registry.dead_tickers(m_name)
+            alive = [t for t in stocks if t not in dead]
+            if len(alive) < len(stocks):
+                print(f"   跳过 {len(stocks) - len(alive)} 只已确认无数据的股票")
+            stocks = alive
+            job.register(stocks, m_name)
+            remaining = set(job.remaining(m_name))
+            print(f"正在处理 {m_name}，共 {len(stocks)} 只股票，待处理 {len(remaining)} 只...")
+            stocks = [t for t in stocks if t in remaining]  # 保持优先级顺序
+            since_dates = get_since_dates(stocks) if incremental else {}
+            if incremental:
+                print(f"   增量模式: {len(since_dates)} 只已有历史，{len(stocks) - len(since_dates)} 只全量下载")
+            if download_mode == 'concurrent':
+                download_concurrent(stocks, m_name, start_date, end_date, method_option, since_dates, job)
+            else:
+                download_chunk(stocks, m_name, start_date, end_date, method_option, since_dates, job)
         except Exception as e:
             print(f"⚠️ 读取 {m_name} 失败: {e}")
+        finally:
+            flush_writer()
                 
     conn_local.close()
+    writer.before_commit = []
+    writer.on_failure = []
+    job.finish()
+    print(f"📋 任务 {job.run_id} 状态统计: {job.summary()}")
+
+def merge_shards():
+    """把 staging 目录下各分片的结果合并进主库 (只能在非分片进程中调用)"""
+    count = merge_staging(con)
+    if count:
+        print(f"🔀 已合并 {count} 个分片的 staging 文件")
+    return count
+
+def download_sharded(workers, market_option, method_option, download_mode='concurrent', incremental=False):
+    """本机多进程：启动 workers 个分片子进程，各自写 staging 文件，全部结束后由本进程统一合并进主库
+    全局请求速率在子进程间平分；失败的分片保留 staging 文件，重新运行时会续传"""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    # 子进程不能打开被本进程占用的主库，最新日期 (排序/增量都要用) 通过快照传递
+    export_last_dates(con)
+    args = json.dumps([market_option, method_option, download_mode, incremental])
+    procs = []
+    for i in range(workers):
+        env = dict(os.environ, SHARD_INDEX=str(i), SHARD_COUNT=str(workers), DOWNLOAD_ARGS=args,
+                   YAHOO_RPS=str(REQUESTS_PER_SECOND / workers))
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    failed = [i for i, p in enumerate(procs) if p.wait() != 0]
+    if failed:
+        print(f"❌ 分片 {failed} 异常退出，暂不合并，请重新运行")
+        return 0
+    return merge_shards()
 
 if __name__ == '__main__':
     market_choice = 0  
     method_choice = 2 
-    
-    download_main(market_choice, method_choice)
+    mode_choice = 'concurrent'  # 'sequential': 单线程; 'concurrent': 并发
+    incremental_choice = False  # True: 只抓取库中最新日期之后的数据
+    shard_workers = 1           # > 1: 本机启动多个分片进程并发下载，结束后合并
+    merge_only = False          # True: 只把 staging 目录中已完成的分片 (如各 Pod 的结果) 合并进主库
+    compact_choice = False      # True: 结束后按 (ticker, date) 重写整张表，回收先删后插留下的空洞 (全量刷新后偶尔运行即可)
+
+    if SHARD_COUNT > 1:
+        # 分片进程：参数由父进程传入；独立部署的分片 (如 k8s Indexed Job) 使用上面的默认值，
+        # 全部完成后在主库所在机器上调用 merge_shards()
+        if os.getenv("DOWNLOAD_ARGS"):
+            market_choice, method_choice, mode_choice, incremental_choice = json.loads(os.environ["DOWNLOAD_ARGS"])
+        download_main(market_choice, method_choice, mode_choice, incremental_choice)
+    elif shard_workers > 1:
+        download_sharded(shard_workers, market_choice, method_choice, mode_choice, incremental_choice)
+    elif merge_only:
+        merge_shards()
+    else:
+        download_main(market_choice, method_choice, mode_choice, incremental_choice)
+    if compact_choice and SHARD_COUNT == 1:
+        compact_stock_data(con)
     print(f"\n同步结束: {datetime.datetime.now().strftime('%H:%M:%S')}")
@@ -3,6 +3,12 @@ import pandas as pd
 import datetime
 import duckdb
 import sys
+import sqlite3
+from util.database_duckdb import COUNTRIES, DB_PATH, LOCAL_DB, META_TABLE, ensure_ticker_meta
+from util.anomaly import detect_anomalies, pending_retries
+from util.failure_registry import FailureRegistry
+from util.qc_state import changed_tickers, finish_qc_run, last_qc_run, start_qc_run
+from util.universe import load_universe
 
 # 强制立即输出日志
 def print_flush(*args, **kwargs):
@@ -13,7 +19,6 @@ VERSION_TAG = "2026-03-02 DuckDB版"
 print_flush(f"📢 [DEBUG] 脚本版本: {VERSION_TAG}")
 
 # DuckDB 配置
-DB_PATH = "yahoo_stock_data.duckdb"
 con = duckdb.connect(DB_PATH)
 
 def get_last_month_last_day():
@@ -24,69 +29,143 @@ def get_last_month_last_day():
     last_day_last_month = first_day_this_month - datetime.timedelta(days=1)
     return last_day_last_month.strftime('%Y-%m-%d')
 
+def load_expected_tickers(local_db=LOCAL_DB):
+    """清单中应当有数据的股票 (已启用且未退市)：(ticker, market)"""
+    if not os.path.exists(local_db):
+        return pd.DataFrame({'ticker': pd.Series(dtype='string'), 'market': pd.Series(dtype='string')})
+    conn_local = sqlite3.connect(local_db)
+    try:
+        frames = []
+        for market in COUNTRIES:
+            try:
+                universe = load_universe(conn_local, market)
+            except Exception as e:
+                print_flush(f"⚠️ 读取 {market} 清单失败: {e}")
+                continue
+            universe = universe[universe['active'] & ~universe['delisted']]
+            frames.append(pd.DataFrame({'ticker': universe['ticker'], 'market': market}))
+    finally:
+        conn_local.close()
+    if not frames:
+        return pd.DataFrame({'ticker': pd.Series(dtype='string'), 'market': pd.Series(dtype='string')})
+    return pd.concat(frames, ignore_index=True).drop_duplicates('ticker')
+
 def run_stable_qc():
     # 判定基准：上月最后一天
     target_date_str = get_last_month_last_day()
     print_flush(f"🚀 开始 DuckDB 本地数据 QC...")
     print_flush(f"📅 判定基准日期: {target_date_str}")
     
-    # 1. 获取所有表名
-    # DuckDB 获取所有表名的快捷命令
+    # 1. 每只股票的首末日期、行数、空收盘价数直接取自写入时维护的 ticker_meta，并与清单做全外连接：
+    #    清单中有、库里没有 (或全部收盘价为空) 的记为空表
+    con.register('_expected_view', load_expected_tickers())
     try:
-        tables_df = con.execute("SHOW TABLES").df()
-        tables = tables_df['name'].tolist()
+        ensure_ticker_meta(con)
+        result = con.execute(f'''
+            WITH stats AS (
+                SELECT ticker, market, first_date, last_date, row_count, null_close
+                FROM {META_TABLE}
+            )
+            SELECT coalesce(s.ticker, e.ticker) AS Ticker,
+                   strftime(s.last_date, '%Y-%m-%d') AS Last_Date,
+                   coalesce(s.market, e.market) AS Market,
+                   strftime(s.first_date, '%Y-%m-%d') AS First_Date,
+                   coalesce(s.row_count, 0) AS Rows,
+                   coalesce(s.null_close, 0) AS Null_Close,
+                   CASE WHEN s.ticker IS NULL OR s.null_close = s.row_count THEN 'Empty'
+                        WHEN s.last_date >= CAST(? AS DATE) THEN 'Updated'
+                        ELSE 'Stale' END AS Status
+            FROM stats s FULL OUTER JOIN _expected_view e ON s.ticker = e.ticker
+            ORDER BY Ticker
+        ''', [target_date_str]).df()
     except Exception as e:
-        print_flush(f"❌ 获取表列表失败: {e}")
+        print_flush(f"❌ 读取 {META_TABLE} 失败: {e}")
         return
+    finally:
+        con.unregister('_expected_view')
     
-    total = len(tables)
-    print_flush(f"🔍 库中共有 {total} 张表")
-    
-    update_list = []    # 1. 有更新
-    failed_list = []    # 2. 更新异常
-    empty_list = []     # 3. 空表
-
-    # 2. 遍历检查
-    for i, table in enumerate(tables):
-        try:
-            # DuckDB 查询最新一条日期
-            # 注意：DuckDB 默认表名不区分大小写，除非加双引号
-            query = f'SELECT "date" FROM "{table}" ORDER BY "date" DESC LIMIT 1'
-            res = con.execute(query).fetchone()
-            
-            if res and res[0]:
-                raw_date = res[0]
-                # DuckDB 返回的通常已经是 datetime 对象
-                if isinstance(raw_date, (datetime.datetime, datetime.date)):
-                    last_dt_str = raw_date.strftime('%Y-%m-%d')
-                else:
-                    last_dt_str = str(raw_date)[:10]
-                
-                # 对比逻辑
-                if last_dt_str >= target_date_str:
-                    update_list.append({"Ticker": table, "Last_Date": last_dt_str})
-                else:
-                    failed_list.append({"Ticker": table, "Last_Date": last_dt_str})
-            else:
-                empty_list.append({"Ticker": table, "Status": "Empty"})
-        
-        except Exception as e:
-            failed_list.append({"Ticker": table, "Last_Date": "Error", "Detail": str(e)[:50]})
-
-        if (i + 1) % 100 == 0 or (i + 1) == total:
-            print_flush(f"⏳ 进度: {i + 1} / {total}")
+    print_flush(f"🔍 共检查 {len(result)} 只股票")
+
+    # 2. 按状态拆分
+    update_df = result[result['Status'] == 'Updated']    # 1. 有更新
+    failed_df = result[result['Status'] == 'Stale']      # 2. 更新异常
+    empty_df = result[result['Status'] == 'Empty']       # 3. 空表
 
     # 3. 保存结果
-    pd.DataFrame(update_list).to_csv('QC_Update.csv', index=False)
-    pd.DataFrame(failed_list).to_csv('QC_UpdateFailed.csv', index=False)
-    pd.DataFrame(empty_list).to_csv('QC_Empty.csv', index=False)
+    update_df.drop(columns='Status').to_csv('QC_Update.csv', index=False)
+    failed_df.drop(columns='Status').to_csv('QC_UpdateFailed.csv', index=False)
+    empty_df[['Ticker', 'Status', 'Market', 'Rows']].to_csv('QC_Empty.csv', index=False)
 
     print_flush("\n" + "="*40)
     print_flush(f"📊 QC 最终统计结果 (DuckDB):")
-    print_flush(f"1. ✅ 有更新股票数: {len(update_list)}  -> QC_Update.csv")
-    print_flush(f"2. ❌ 更新滞后/异常数: {len(failed_list)}  -> QC_UpdateFailed.csv")
-    print_flush(f"3. 🕳️ 空表数量: {len(empty_list)}  -> QC_Empty.csv")
+    print_flush(f"1. ✅ 有更新股票数: {len(update_df)}  -> QC_Update.csv")
+    print_flush(f"2. ❌ 更新滞后/异常数: {len(failed_df)}  -> QC_UpdateFailed.csv")
+    print_flush(f"3. 🕳️ 空表数量: {len(empty_df)}  -> QC_Empty.csv")
     print_flush("="*40)
+    return result
+
+def run_anomaly_qc(changed=None):
+    """数据异常检测：窗口函数一次扫描全部股票 (跳变、非正价格、high<low、长期不变、成交量放大、
+    疑似未复权拆股、月份缺口)，需要重下的股票直接登记到失败登记表的重试队列
+    changed: 增量模式下只检查这些股票，结果并入上一次的 QC_Anomalies.csv"""
+    print_flush("🧪 开始数据异常检测..." + (f" (增量: {len(changed)} 只)" if changed is not None else ""))
+    try:
+        if changed is None:
+            anomalies = detect_anomalies(con)
+        else:
+            con.register('_changed_view', pd.DataFrame({'ticker': pd.Series(changed, dtype='string')}))
+            try:
+                anomalies = detect_anomalies(con, '_changed_view')
+            finally:
+                con.unregister('_changed_view')
+    except Exception as e:
+        print_flush(f"❌ 异常检测失败: {e}")
+        return
+
+    report = anomalies
+    if changed is not None and os.path.exists('QC_Anomalies.csv'):
+        previous = pd.read_csv('QC_Anomalies.csv', dtype={'Ticker': str, 'Market': str})
+        previous = previous[~previous['Ticker'].isin(set(changed))]
+        report = pd.concat([previous, anomalies], ignore_index=True).sort_values(['Ticker', 'Flag'])
+    report.to_csv('QC_Anomalies.csv', index=False)
+
+    # 已重下过且内容没变、或没有新异常的股票不再加入队列
+    candidates = pending_retries(con, anomalies)
+    if candidates:
+        registry = FailureRegistry()
+        registry.record_failures(candidates, error_class='data_odd')
+        registry.close()
+
+    print_flush(f"4. 🧪 异常记录: {len(report)} 条，涉及 {report['Ticker'].nunique()} 只股票  -> QC_Anomalies.csv")
+    if not report.empty:
+        print_flush(f"   按类型: {report.groupby('Flag')['Ticker'].nunique().to_dict()}")
+    print_flush(f"   已加入重试队列: {len(candidates)} 只")
+    return anomalies
+
+def run_qc(incremental=False):
+    """完整 QC 流程，记录到 qc_runs
+    incremental=True: 只对上次成功 QC 之后有写入的股票做异常检测；首次运行或判定基准月份变了时自动做全量
+    更新状态 / 空表统计只读 ticker_meta，每次都全量计算"""
+    target_date_str = get_last_month_last_day()
+    changed = None
+    ensure_ticker_meta(con)
+    if incremental:
+        last = last_qc_run(con)
+        if last and last[1].strftime('%Y-%m-%d') == target_date_str:
+            changed = changed_tickers(con, last[0])
+        else:
+            print_flush("ℹ️ 没有同一基准日期的 QC 记录，执行全量 QC")
+
+    run_id = start_qc_run(con, 'incremental' if changed is not None else 'full', target_date_str)
+    result = run_stable_qc()
+    anomalies = run_anomaly_qc(changed)
+    if result is None or anomalies is None:
+        # 任一阶段失败都不推进水位线，下一次增量 QC 仍会检查这些股票
+        finish_qc_run(con, run_id, status='failed')
+        print_flush("❌ QC 未完成，本次运行不作为增量基准")
+        return
+    finish_qc_run(con, run_id, len(changed) if changed is not None else len(result))
 
 if __name__ == '__main__':
-    run_stable_qc()
+    incremental_choice = True  # True: 只检查上次 QC 之后变动过的股票; False: 全量
+    run_qc(incremental_choice)
@@ -1,61 +1,145 @@
+import glob
 import os
+import time
+import duckdb
 import pandas as pd
-from util.database_postgresql import create_table_if_not_exists, save_data_to_db
+from util.database_duckdb import DB_PATH, COLUMNS
+from util.pg_sink import close_pool, create_target_table, sync_from_duckdb, write_frame
 
 MIGRATE_FOLDERS = ['csv', 'new_csv']  # 要迁移的文件夹，后者的优先级更高
 COUNTRIES = ['Shanghai_Shenzhen', 'Snp500_Ru1000', 'TSX']
+# CSV 列 -> 类型；不存在的列读出为空
+CSV_TYPES = {'Date': 'DATE', 'Open': 'DOUBLE', 'High': 'DOUBLE', 'Low': 'DOUBLE',
+             'Close': 'DOUBLE', 'Adj Close': 'DOUBLE', 'Volume': 'DOUBLE'}
+# CSV 列名 -> 数据库列名
+CSV_COLUMNS = {'Date': 'date', 'Open': 'open', 'High': 'high', 'Low': 'low',
+               'Close': 'close', 'Adj Close': 'adj_close', 'Volume': 'volume'}
+
+
+def _read_header(file_path):
+    with open(file_path, 'rb') as f:
+        return f.readline().strip()
+
+
+def _csv_sources(country):
+    """按表头把文件分组：同一组的列相同，可以用一次 read_csv 读完，不必逐个文件推断列"""
+    selects = []
+    for priority, root_folder in enumerate(MIGRATE_FOLDERS):
+        groups = {}
+        for file_path in glob.glob(os.path.join(root_folder, country, '*.csv')):
+            groups.setdefault(_read_header(file_path), []).append(file_path.replace("'", "''"))
+        for files in groups.values():
+            file_list = ', '.join(f"'{f}'" for f in files)
+            selects.append(f"""
+                SELECT *, {priority} AS priority
+                FROM read_csv([{file_list}], filename = true, all_varchar = true, header = true)
+            """)
+    return selects
+
+
+def _frame_with_pandas(country):
+    """DuckDB 读取失败 (例如 GBK 编码) 时的后备：逐个文件用 pandas 读取"""
+    frames = []
+    for priority, root_folder in enumerate(MIGRATE_FOLDERS):
+        for file_path in sorted(glob.glob(os.path.join(root_folder, country, '*.csv'))):
+            try:
+                try:
+                    df = pd.read_csv(file_path, dtype=str, encoding='utf-8')
+                except UnicodeDecodeError:
+                    df = pd.read_csv(file_path, dtype=str, encoding='gbk')
+            except Exception as e:
+                print(f"读取 {file_path} 失败: {e}")
+                continue
+            df['filename'] = file_path
+            df['priority'] = priority
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def _dedupe(con, source):
+    """文件名即股票代码；同一 (ticker, Date) 只保留优先级最高的文件中的一行"""
+    present = {row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+    columns = ', '.join(
+        f'TRY_CAST("{col}" AS {typ}) AS "{col}"' if col in present else f'CAST(NULL AS {typ}) AS "{col}"'
+        for col, typ in CSV_TYPES.items())
+    return con.execute(f"""
+        SELECT * EXCLUDE (priority) FROM (
+            SELECT regexp_extract(replace(filename, '\\', '/'), '([^/]+)\\.csv$', 1) AS ticker,
+                   priority, {columns}
+            FROM {source}
+        )
+        WHERE "Date" IS NOT NULL
+        QUALIFY row_number() OVER (PARTITION BY ticker, "Date" ORDER BY priority DESC) = 1
+        ORDER BY ticker, "Date"
+    """).df()
+
+
+def load_market_csvs(con, country):
+    """一次读取某市场在所有文件夹下的 CSV (DuckDB 多线程)，按 (ticker, Date) 去重，new_csv 优先
+    返回去重后的 DataFrame：ticker + CSV 列；没有文件时返回 None"""
+    selects = _csv_sources(country)
+    if not selects:
+        return None
+    try:
+        return _dedupe(con, f"({' UNION ALL BY NAME '.join(selects)})")
+    except duckdb.Error as e:
+        print(f"⚠️ {country} 批量读取失败，改为逐个文件读取: {str(e).splitlines()[0]}")
+
+    raw = _frame_with_pandas(country)
+    if raw is None:
+        return None
+    con.register('_raw_csv', raw)
+    try:
+        return _dedupe(con, '_raw_csv')
+    finally:
+        con.unregister('_raw_csv')
 
 
 def migrate_csv_to_postgresql_full():
-    """遍历指定的 CSV 文件夹并将其内容导入到 PostgreSQL 数据库。
-    由于数据库使用了 ON CONFLICT UPDATE (UPSERT)，后处理的数据会覆盖先处理的数据。
+    """把所有 CSV 一次性批量读入并去重 (new_csv 覆盖 csv 中相同日期的数据)，再整批 COPY 进 PostgreSQL。
+    由于数据库使用了 ON CONFLICT UPDATE (UPSERT)，重复运行结果不变。
     """
 
-    create_table_if_not_exists()
+    create_target_table()
 
-    total_files = 0
+    total_tickers = 0
     total_rows = 0
+    start = time.time()
+    con = duckdb.connect()
 
-    # 按照优先级处理文件夹，确保 'new_csv' 最后处理以覆盖旧数据
-    for root_folder in MIGRATE_FOLDERS:
-        for country in COUNTRIES:
-            country_path = os.path.join(root_folder, country)
+    for country in COUNTRIES:
+        data = load_market_csvs(con, country)
+        if data is None or data.empty:
+            continue
+        print(f"{country}: 读取并去重后 {data['ticker'].nunique()} 只股票，{len(data)} 行 ({time.time() - start:.1f}s)")
 
-            # 检查路径是否存在
-            if not os.path.exists(country_path):
-                continue
+        data = data.rename(columns=CSV_COLUMNS)
+        data['market'] = country
+        total_rows += write_frame(data[COLUMNS])
+        total_tickers += data['ticker'].nunique()
 
-            for file_name in os.listdir(country_path):
-                if file_name.endswith('.csv'):
-                    # 提取股票代码
-                    ticker = file_name.replace('.csv', '')
-                    file_path = os.path.join(country_path, file_name)
-
-                    try:
-                        # 1. 读取 CSV 文件
-                        try:
-                            df = pd.read_csv(file_path, parse_dates=['Date'], encoding='utf-8')
-                        except UnicodeDecodeError:
-                            df = pd.read_csv(file_path, parse_dates=['Date'], encoding='gbk')
-                        # 确保有数据才处理
-                        if df.empty:
-                            continue
-                        rows_count = len(df)
-                        total_files += 1
-
-                        # 2. 写入数据库 (save_data_to_db 实现了 PostgreSQL 的 UPSERT 逻辑)
-                        save_data_to_db(df, ticker, country)
-
-                        total_rows += rows_count
-                        print(f"{root_folder}/{ticker}: 导入 {rows_count} 行数据。")
-
-                    except Exception as e:
-                        print(f"导入 {file_path} 失败: {e}")
-
-    print(f"\n总共处理了 {total_files} 个文件，导入/更新了 {total_rows} 行数据。")
+    con.close()
+    close_pool()
+    print(f"\n总共导入 {total_tickers} 只股票，导入/更新了 {total_rows} 行数据，用时 {time.time() - start:.1f}s。")
     print("数据库已与 CSV 文件同步。")
 
 
+def sync_duckdb_to_postgresql(tickers=None):
+    """把 DuckDB 仓库 (或其中部分股票) 批量同步到 PostgreSQL"""
+    create_target_table()
+    con = duckdb.connect(DB_PATH, read_only=True)
+    try:
+        sync_from_duckdb(con, tickers=tickers)
+    finally:
+        con.close()
+        close_pool()
+    print("PostgreSQL 已与 DuckDB 仓库同步。")
+
+
 if __name__ == '__main__':
-    # 仅需运行一次，将所有旧数据导入数据库
-    migrate_csv_to_postgresql_full()
\ No newline at end of file
+    # 'csv': 仅需运行一次，将所有旧数据导入数据库；'duckdb': 从 DuckDB 仓库同步
+    source_choice = 'csv'
+    if source_choice == 'duckdb':
+        sync_duckdb_to_postgresql()
+    else:
+        migrate_csv_to_postgresql_full()
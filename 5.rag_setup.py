@@ -3,6 +3,7 @@ import time
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import DashScopeEmbeddings
 from langchain_core.documents import Document
+from util.parquet_store import QUERY_PARQUET_DIR
 
 # 配置
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
@@ -12,8 +13,8 @@ INDEX_PATH = "llama_index_stock_index"
 def define_rag_documents():
     """定义知识库内容"""
     texts = [
-        "数据库运行在 DuckDB 引擎上。包含：`stock_data` 表和 `stock_monthly_change` 视图。",
-        "`stock_data` 字段：Ticker (TEXT), Date (DATE), Country (TEXT), Open (DOUBLE), High (DOUBLE), Low (DOUBLE), Close (DOUBLE), \"Adj Close\" (DOUBLE), Volume (BIGINT)。",
+        "数据库运行在 DuckDB 引擎上。包含：`stock_data` 表 (所有股票的月度行情合并在一张表中) 和 `stock_monthly_change` 视图。",
+        "`stock_data` 字段：Ticker (TEXT), Country (TEXT), Date (DATE), Open (DOUBLE), High (DOUBLE), Low (DOUBLE), Close (DOUBLE), \"Adj Close\" (DOUBLE), Volume (BIGINT)。",
         "`stock_monthly_change` 字段：Ticker (TEXT), Country (TEXT), Month_Start_Date (DATE), Monthly_Close (REAL), Prev_Monthly_Close (REAL), Monthly_Change_Amt (REAL), Monthly_Change_Pct (REAL)。",
         "**ABSOLUTE CRITICAL DUCKDB RULE:** 字段名引用必须保持一致。带空格的字段如 \"Adj Close\" 必须加双引号。普通字段如 Ticker, Monthly_Change_Pct 不加引号，不转小写。",
         "**ABSOLUTE CRITICAL OUTPUT RULE:** 所有查询必须 SELECT `Ticker` 和相应的日期字段 (Date 或 Month_Start_Date)。",
@@ -22,6 +23,9 @@ def define_rag_documents():
         "**CASE INSENSITIVITY:** 始终使用 UPPER(Ticker) = UPPER('000001.SZ') 进行过滤。",
         "**JOIN RULE:** 联接两表时使用 T1.Ticker = T2.Ticker AND date_trunc('month', T1.Date) = date_trunc('month', T2.Month_Start_Date)。"
     ]
+    # Parquet 查询层的 stock_data 带分区列 year，只有按 year 过滤才会跳过其他年份的文件
+    if QUERY_PARQUET_DIR:
+        texts.append("**PARQUET YEAR RULE:** `stock_data` 另有分区列 year (INTEGER)。过滤年份时写 year = 2025 (可与 year(Date) = 2025 同时使用)，只读取对应年份的数据。")
     return [Document(page_content=t) for t in texts]
 
 def setup_rag_index_langchain():
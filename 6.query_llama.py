@@ -5,17 +5,14 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import pandas as pd
 import duckdb
+from util.database_duckdb import DB_PATH as DUCKDB_DB_NAME, TABLE_NAME, connect_query_db
+from util.parquet_store import QUERY_PARQUET_DIR, connect_parquet
 
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import DashScopeEmbeddings
 
-# 数据库配置 (DuckDB)
-DUCKDB_DB_NAME = 'yahoo_stock_data.duckdb'
-TABLE_NAME = 'stock_data'
-VIEW_NAME = 'stock_monthly_change'
-
 # LLM 和 RAG 配置
 LLM_MODEL_NAME = "qwen3.5-plus" 
 API_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
@@ -27,65 +24,21 @@ INDEX_PATH = "llama_index_stock_index"
 class DBManager:
     """DuckDB 数据库连接管理和执行"""
     def get_connection(self) -> duckdb.DuckDBPyConnection:
-        return duckdb.connect(database=DUCKDB_DB_NAME)
+        # 设置了 QUERY_PARQUET_DIR 时读取 Parquet 导出层，不占用主库的文件锁
+        if QUERY_PARQUET_DIR:
+            return connect_parquet(QUERY_PARQUET_DIR)
+        # 只读挂载主库；月度涨跌表由写入路径增量维护，查询前不再重算
+        return connect_query_db(DUCKDB_DB_NAME)
 
     def execute_sql_and_fetch(self, query: str) -> pd.DataFrame:
         conn = self.get_connection()
         try:
-            # 1. 获取所有原始股票表名
+            # 1. 所有股票已合并在 stock_data 长表中
             tables = conn.execute("SELECT table_name FROM information_schema.tables").fetchall()
-            # 排除掉我们自己生成的视图名
-            table_names = [t[0] for t in tables if t[0] not in [VIEW_NAME, 'stock_data', 'stock_monthly_change']]
-
-            if not table_names:
-                raise Exception("数据库中没有任何股票数据表，请先运行下载脚本。")
-
-            # 2. 构造动态视图：将下划线还原为点，并自动打市场标签
-            sql_parts = []
-            for name in table_names:
-                if '_' in name:
-                    parts = name.split('_')
-                    display_ticker = f"{''.join(parts[:-1])}.{parts[-1]}".upper()
-                    # 自动识别市场
-                    suffix = parts[-1].lower()
-                    if suffix in ['sz', 'ss']: country = 'Shanghai_Shenzhen'
-                    elif suffix == 'to': country = 'TSX'
-                    else: country = 'US_Market'
-                else:
-                    display_ticker = name.upper()
-                    country = 'Snp500_Ru1000'
-
-                sql_parts.append(f"""
-                    SELECT 
-                        '{display_ticker}' as Ticker, 
-                        '{country}' as Country, 
-                        CAST(date AS DATE) as Date, 
-                        open as Open, high as High, low as Low, close as Close, 
-                        adj_close as "Adj Close", volume as Volume 
-                    FROM "{name}"
-                """)
-
-            # 合并所有表
-            union_query = f"CREATE OR REPLACE VIEW stock_data AS {' UNION ALL '.join(sql_parts)}"
-            conn.execute(union_query)
-
-            # 3. 创建分析视图
-            conn.execute(f"""
-                CREATE OR REPLACE VIEW {VIEW_NAME} AS
-                SELECT *, 
-                LAG(Monthly_Close) OVER (PARTITION BY Ticker ORDER BY Month_Start_Date) as Prev_Monthly_Close,
-                (Monthly_Close - LAG(Monthly_Close) OVER (PARTITION BY Ticker ORDER BY Month_Start_Date)) as Monthly_Change_Amt,
-                ((Monthly_Close / NULLIF(LAG(Monthly_Close) OVER (PARTITION BY Ticker ORDER BY Month_Start_Date), 0)) - 1) * 100 as Monthly_Change_Pct
-                FROM (
-                    SELECT Ticker, Country, 
-                           CAST(date_trunc('month', Date) AS DATE) as Month_Start_Date,
-                           LAST(Close) as Monthly_Close
-                    FROM stock_data
-                    GROUP BY Ticker, Country, Month_Start_Date
-                )
-            """)
-
-            # 4. 执行 LLM 生成的查询
+            if TABLE_NAME not in [t[0] for t in tables]:
+                raise Exception("数据库中没有 stock_data 表，请先运行下载脚本。")
+
+            # 2. 执行 LLM 生成的查询
             df_result = conn.execute(query).fetchdf()
             
             df_result = df_result.fillna(0)
@@ -114,7 +67,7 @@ class MockDuckDBSchema:
     def get_table_info(self):
         return (
             "Table stock_data has columns: Ticker (TEXT), Country (TEXT), Date (DATE), Open (DOUBLE), High (DOUBLE), Low (DOUBLE), Close (DOUBLE), \"Adj Close\" (DOUBLE), Volume (BIGINT)."
-            "View stock_monthly_change has columns: Ticker (TEXT), Country (TEXT), Month_Start_Date (TEXT), Monthly_Close (REAL), Prev_Monthly_Close (REAL), Monthly_Change_Amt (REAL), Monthly_Change_Pct (REAL)."
+            "View stock_monthly_change has columns: Ticker (TEXT), Country (TEXT), Month_Start_Date (DATE), Monthly_Close (REAL), Prev_Monthly_Close (REAL), Monthly_Change_Amt (REAL), Monthly_Change_Pct (REAL)."
         )
 
 
@@ -1,9 +1,11 @@
 # 7.create_view.py
 
-from util.database_postgresql import create_monthly_change_view
+from util.pg_sink import close_pool, create_monthly_change_view, create_target_table
 
 if __name__ == '__main__':
     print("启动创建/更新月度变化视图程序")
-    # 调用 database_postgresql.py 中定义的函数来执行 SQL 视图创建语句
+    # 视图建在 pg_sink 写入的目标表上，表不存在时先建表
+    create_target_table()
     create_monthly_change_view()
+    close_pool()
     print("月度变化视图创建完成")
\ No newline at end of file
@@ -4,8 +4,9 @@ import time
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import pandas as pd
-import duckdb
 import streamlit as st
+from util.database_duckdb import DB_PATH as DUCKDB_DB_NAME, connect_query_db
+from util.parquet_store import QUERY_PARQUET_DIR, connect_parquet
 
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
@@ -20,7 +21,6 @@ LLM_MODEL_NAME = "doubao-seed-1-6"
 API_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
 # LLM_MODEL_NAME = "qwen3.5-plus"
 # API_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
-DUCKDB_DB_NAME = 'yahoo_stock_data.duckdb'
 INDEX_PATH = "llama_index_stock_index"
 
 # 历史记录初始化
@@ -31,31 +31,15 @@ if 'history' not in st.session_state:
 # 数据库管理类
 class DBManager:
     def get_connection(self):
-        return duckdb.connect(database=DUCKDB_DB_NAME)
+        # 设置了 QUERY_PARQUET_DIR 时读取 Parquet 导出层，不占用主库的文件锁
+        if QUERY_PARQUET_DIR:
+            return connect_parquet(QUERY_PARQUET_DIR)
+        # 只读挂载主库；月度涨跌表由写入路径增量维护，查询前不再重算
+        return connect_query_db(DUCKDB_DB_NAME)
 
     def execute_sql_and_fetch(self, query: str) -> pd.DataFrame:
         conn = self.get_connection()
         try:
-            tables = conn.execute("SELECT table_name FROM information_schema.tables").fetchall()
-            table_names = [t[0] for t in tables if t[0] not in ['stock_monthly_change', 'stock_data']]
-            if table_names:
-                sql_parts = []
-                for name in table_names:
-                    parts = name.split('_')
-                    display_ticker = f"{''.join(parts[:-1])}.{parts[-1]}".upper() if '_' in name else name.upper()
-                    sql_parts.append(
-                        f"SELECT '{display_ticker}' as Ticker, CAST(date AS DATE) as Date, open as Open, high as High, low as Low, close as Close, adj_close as \"Adj Close\", volume as Volume FROM \"{name}\"")
-                conn.execute(f"CREATE OR REPLACE VIEW stock_data AS {' UNION ALL '.join(sql_parts)}")
-                conn.execute(f"""
-                    CREATE OR REPLACE VIEW stock_monthly_change AS
-                    SELECT *, 
-                    LAG(Monthly_Close) OVER (PARTITION BY Ticker ORDER BY Month_Start_Date) as Prev_Monthly_Close,
-                    ((Monthly_Close / NULLIF(LAG(Monthly_Close) OVER (PARTITION BY Ticker ORDER BY Month_Start_Date), 0)) - 1) * 100 as Monthly_Change_Pct
-                    FROM (
-                        SELECT Ticker, CAST(date_trunc('month', Date) AS DATE) as Month_Start_Date, LAST(Close) as Monthly_Close
-                        FROM stock_data GROUP BY Ticker, Month_Start_Date
-                    )
-                """)
             return conn.execute(query).fetchdf().fillna(0)
         finally:
             conn.close()
@@ -0,0 +1,16 @@
+# 9.export_parquet.py
+# 把 DuckDB 仓库导出成按 market / year 分区的 Parquet，查询层设置 QUERY_PARQUET_DIR 后直接读取
+import time
+import duckdb
+from util.database_duckdb import DB_PATH
+from util.parquet_store import PARQUET_DIR, current_version_dir, export_parquet
+
+if __name__ == '__main__':
+    print("开始导出 Parquet...")
+    start = time.time()
+    con = duckdb.connect(DB_PATH, read_only=True)
+    try:
+        rows = export_parquet(con)
+    finally:
+        con.close()
+    print(f"✅ 导出 {rows} 行到 {current_version_dir(PARQUET_DIR)}/ ，用时 {time.time() - start:.1f}s")
@@ -1,14 +1,25 @@
 import datetime
 import time
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill
 import random
 import re
 import threading
+import duckdb
 import pandas as pd
 import yfinance as yf
 from calendar import monthrange
-import requests
+from concurrent.futures import ThreadPoolExecutor
 import os
+from util.chart_parser import parse_chart
+from util.database_duckdb import DB_PATH, StockWriter, ensure_monthly_change
+from util.failure_registry import FailureRegistry
+from util.month_end import to_month_end
+from util.symbol_index import MASTER_XLSX, get_symbol_index
+from util.rate_control import AdaptiveLimiter, backoff_delay, is_throttled
+from util import yahoo_client
+from util.yahoo_client import CacheMissError, configure_session, fetch_chart_raw
 
 # warnings.filterwarnings("ignore", category=FutureWarning, module="yfinance")
 
@@ -20,12 +31,28 @@ color = ['ffd2d2', 'ff8eff', 'd3a4ff', 'b9b9ff',
          'ff9d6f', 'ff9224', 'ffff37', '9aff02',
          'e1c4c4', 'dedebe', 'c4e1e1', 'e6e6f2']
 
+# 解析结果列名 -> new_csv 中沿用的列名
+CSV_COLUMNS = {'date': 'Date', 'open': 'Open', 'high': 'High', 'low': 'Low',
+               'close': 'Close', 'adj_close': 'Adj Close', 'volume': 'Volume'}
+
 pattern = [' download failed.', ' is blank.', ' is not comparable.', ' data odd.', r'retry over \d time.']
 
+# 录入 Excel：清单工作表序号 -> (代码列, 内容列1, 内容列2)，列号从 0 开始，None 表示留空
+FAIL_COLUMNS = {1: (0, 1, 2), 2: (1, 4, None), 3: (1, 2, 5)}
+FAIL_EXCEL_DIR = 'failed_txt'
+
+# 重新下载的线程池大小 (固定)；实际并发与速率由 AdaptiveLimiter 按 Yahoo 的响应自动调整
+REDOWNLOAD_WORKERS = 16
+
 
 def main_process(Download=None, txt='failed_txt/failed.txt'):
     global failedList, old_failedList
 
+    if Download:
+        # 重试队列直接来自失败登记表，不再解析文本；仍失败的股票写回 txt 供录入 Excel
+        Redownload(redownload_txt=txt)
+        return
+
     # 读取、清洗失败数据文本
     with open(txt, 'r', encoding='utf-8') as f:
         old_failedList = f.readlines()  # 存放下载失败数据
@@ -38,9 +65,7 @@ def main_process(Download=None, txt='failed_txt/failed.txt'):
         if line != '':
             failedList.append(line)
 
-    if Download:
-        Redownload(redownload_txt=txt)
-    elif not Download:
+    if not Download:
         ToExcel()
     else:
         print('''
@@ -50,9 +75,55 @@ def main_process(Download=None, txt='failed_txt/failed.txt'):
         ''')
 
 
-fail_download = {'Shanghai_Shenzhen': [], 'Snp500_Ru1000': [], 'TSX': []}
+_writer = None
+_writer_lock = threading.Lock()
+
 
-def downloader(ticker, data_name, start_date, end_date, sleep_time=1, repeat=3, option=None):
+def get_writer():
+    """重新下载的数据同时写入 DuckDB (stock_data + ticker_meta)；主库被其他进程占用时只写 CSV"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            try:
+                con = duckdb.connect(DB_PATH)
+                ensure_monthly_change(con)
+                _writer = StockWriter(con)
+            except duckdb.Error as e:
+                print(f"⚠️ 无法打开 {DB_PATH}，只写 CSV: {e}")
+                _writer = False
+        return _writer or None
+
+
+def flush_writer():
+    writer = get_writer()
+    if writer:
+        with _writer_lock:
+            count = writer.flush()
+        if count:
+            print(f"💾 批量入库 {count} 只股票")
+
+
+def save_monthly_csv(df, data_name, ticker, source=None):
+    """日线聚合成自然月月线 (开高低收量)，写入 new_csv/<市场>/<股票>.csv 和 DuckDB
+    DuckDB 中只替换本次下载覆盖到的月份，之后的月份 (例如主下载程序写入的当月数据) 保持不变"""
+    df_monthly = to_month_end(df, date_col='Date', price_col='Close')
+
+    writer = get_writer()
+    if writer and not df_monthly.empty:
+        until = df_monthly['Date'].max() + pd.offsets.MonthEnd(0)
+        with _writer_lock:
+            writer.add(df_monthly.rename(columns={v: k for k, v in CSV_COLUMNS.items()}),
+                       ticker, data_name, source=source, until=until)
+
+    df_monthly['Date'] = df_monthly['Date'].dt.strftime('%Y-%m-%d')
+    os.makedirs(os.path.join('new_csv', data_name), exist_ok=True)
+    filepath = os.path.join('new_csv', data_name, f"{ticker}.csv")
+    df_monthly.to_csv(filepath, index=False)
+    return df_monthly
+
+
+def downloader(ticker, data_name, start_date, end_date, sleep_time=1, repeat=3, option=None, limiter=None,
+               registry=None):
     """
     下载股票数据，支持yfinance和requests两种方式，并可选择下载方式。
     参数:
@@ -60,41 +131,55 @@ def downloader(ticker, data_name, start_date, end_date, sleep_time=1, repeat=3,
         data_name (str): 数据类别名称（用于创建子文件夹）。
         start_date (datetime.date): 数据开始日期。
         end_date (datetime.date): 数据结束日期。
-        sleep_time (int): 每次重试前的等待时间（秒）。
+        sleep_time (int): 重试退避的基准时间（秒），第 n 次重试最多等待 sleep_time * 2^n 秒（随机抖动）。
         repeat (int): 最大重试次数。
         option (int, optional): 下载方式选项。
             - None (或任何非0/1值): 先尝试yfinance，失败后回退到requests。
             - 0: 只尝试yfinance。
             - 1: 只尝试requests。
             默认为 None。
+        limiter (AdaptiveLimiter, optional): 共享的自适应限速器，每次网络请求前获取许可。
+        registry (FailureRegistry, optional): 失败登记表，结束后记录成功或失败。
+    返回:
+        bool: 是否下载成功。
     """
-    for _ in range(repeat):
-        if option is None or option == 0:
+    limiter = limiter or AdaptiveLimiter()
+    ok, last_error = False, None
+    # 离线回放只能读取 chart 接口的缓存，yfinance 无法走缓存，直接跳过 (与主下载程序的 fetch_ticker 一致)
+    use_yfinance = (option is None or option == 0) and not yahoo_client.OFFLINE
+    if option == 0 and yahoo_client.OFFLINE:
+        last_error = CacheMissError(f"离线模式无法使用 yfinance: {ticker}")
+    for attempt in range(repeat):
+        if use_yfinance:
             try:
-                data = yf.Ticker(ticker).history(
-                    period="max",
-                    interval="1d",
-                    start=start_date,
-                    end=end_date,
-                    prepost=False,
-                    actions=False,
-                    auto_adjust=False,
-                    back_adjust=False,
-                    proxy=None,
-                    rounding=False
-                )
+                with limiter.request():
+                    data = yf.Ticker(ticker).history(
+                        period="max",
+                        interval="1d",
+                        start=start_date,
+                        end=end_date,
+                        prepost=False,
+                        actions=False,
+                        auto_adjust=False,
+                        back_adjust=False,
+                        proxy=None,
+                        rounding=False
+                    )
                 if data is None or data.shape[0] <= 1:
-                    fail_download[data_name].append(ticker)
+                    last_error = 'yfinance 返回空数据'
                     print(ticker + ' None')
                 else:
-                    # data = data.asfreq('ME', method='pad')  # 数据频度为每月（python环境3.11）
-                    data = data.asfreq('M', method='pad')    # 数据频度为每月（python环境3.7）
-                    data.to_csv(r'new_csv\\' + str(data_name) + r"\\" + str(ticker) + '.csv')
+                    # 与 requests 分支使用同一个月末对齐函数
+                    data = data.reset_index()
+                    data['Date'] = pd.to_datetime(data['Date']).dt.tz_localize(None)
+                    save_monthly_csv(data, data_name, ticker, source='yf')
                     print(ticker + ' Successful')
+                    ok = True
                 break
             except Exception as e:
+                last_error = e
                 print(f"{ticker} Error: {e}")
-                time.sleep(sleep_time)
+                time.sleep(backoff_delay(attempt, sleep_time))
 
         # 使用 requests 备用接口
         # 仅当 option 为 None (默认行为) 或 option 为 1 时尝试
@@ -119,190 +204,115 @@ def downloader(ticker, data_name, start_date, end_date, sleep_time=1, repeat=3,
                 start_unix = int(time.mktime(start_date.timetuple()))
                 # Yahoo Finance API 的 end_unix 通常是独占的，所以加一天然后减去 1 秒
                 end_unix = int(time.mktime((req_end_date + datetime.timedelta(days=1)).timetuple())) - 1
-                url = f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}?period1={start_unix}&period2={end_unix}&interval=1d&events=div%2Csplits"
-                headers = {
-                    "User-Agent": "Mozilla/5.0",
-                    "Accept-Language": "en-US,en;q=0.9",
-                    "Accept": "application/json",
-                    "Referer": "https://finance.yahoo.com/",
-                }
-                response = requests.get(url, headers=headers, timeout=10)
-                if response.status_code != 200:
-
-                    raise ValueError(f"requests 状态码错误: {response.status_code}")
-                result = response.json()
-                chart = result.get("chart", {})
-                if chart.get("error"):
-                    fail_download[data_name].append(ticker)
-                    raise ValueError(f"requests API 错误: {chart['error']}")
-
-                result_data = chart.get("result", [])
-                if not result_data:
-                    fail_download[data_name].append(ticker)
-                    raise ValueError("requests 未返回数据。")
-
-                timestamps = result_data[0].get("timestamp", [])
-                indicators = result_data[0].get("indicators", {})
-                quote = indicators.get("quote", [{}])[0]
-                adjclose_data = indicators.get("adjclose", [{}])[0]
-
-                if not timestamps or not quote.get("close") or not adjclose_data.get("adjclose"):
-                    fail_download[data_name].append(ticker)
+                # 共享连接池的 Session，非 200 状态码会抛出 YahooHTTPError
+                with limiter.request():
+                    raw = fetch_chart_raw(ticker, start_unix, end_unix, interval='1d',
+                                          events='div,splits', timeout=10)
+                # 字节流直接解析成带类型的列，不再经过 Python 列表逐行转换
+                df = parse_chart(raw)
+
+                if df.empty or df['close'].isna().all() or df['adj_close'].isna().all():
                     raise ValueError("requests 数据缺失: 收盘价或调整收盘价数据缺失。")
 
-                df = pd.DataFrame({
-                    "Date": pd.to_datetime([datetime.datetime.utcfromtimestamp(ts) for ts in timestamps]),
-                    "Open": quote.get("open", []),
-                    "High": quote.get("high", []),
-                    "Low": quote.get("low", []),
-                    "Close": quote.get("close", []),
-                    "Adj Close": adjclose_data.get("adjclose", []),
-                    "Volume": quote.get("volume", []),
-                })
+                df = df.rename(columns=CSV_COLUMNS)
 
                 if df.shape[0] <= 1:
                     raise ValueError("requests 数据不足。")
 
-                # 对齐到自然月的最后一天，填充缺失日期
-                monthly_rows = []
-                for ym, group in df.groupby(df['Date'].dt.to_period('M')):
-                    last_day = ym.to_timestamp(how='end')
-                    # 确保处理 'Close' 列中的 NaN 值以确定最后一个有效行
-                    last_valid_row = group.loc[group['Close'].notna()].iloc[-1]
-                    if last_valid_row['Date'].date() == last_day.date():
-                        monthly_rows.append(last_valid_row)
-                    else:
-                        new_row = last_valid_row.copy()
-                        new_row['Date'] = last_day
-                        monthly_rows.append(new_row)
-
-                df_monthly = pd.DataFrame(monthly_rows)
-                df_monthly['Date'] = df_monthly['Date'].dt.strftime('%Y-%m-%d')
-
-                os.makedirs(os.path.join('new_csv', data_name), exist_ok=True)
-                filepath = os.path.join('new_csv', data_name, f"{ticker}.csv")
-                df_monthly.to_csv(filepath, index=False)
+                # 对齐到自然月的最后一天
+                save_monthly_csv(df, data_name, ticker, source='API')
                 print(f"{ticker} requests API 下载成功。")
-                return  # 成功下载，退出
+                ok = True
+                break  # 成功下载，退出
 
             except Exception as e_req:
-                if option == 1: # 如果只选择 requests，则不尝试 yfinance
+                last_error = e_req
+                # 只选择 requests 或离线回放 (不会再尝试 yfinance，缓存未命中重试也无意义) 时直接结束
+                if (option == 1 or yahoo_client.OFFLINE) and not is_throttled(e_req):
                     print(f"{ticker} requests API 下载失败: {e_req}")
-                    break # 退出重试循环
+                    break # 退出重试循环；被限流 (429/5xx) 时退避后重试
                 else: # 如果 option 为 None，则返回 yfinance（通过外部循环重试）
                     print(f"{ticker} requests API 下载失败: {e_req}")
-                    time.sleep(sleep_time)
+                    time.sleep(backoff_delay(attempt, sleep_time))
                     # 如果 requests 失败且不是 requests-only 模式，它将重试外部循环，
                     # 外部循环将再次尝试 yfinance（如果 option 为 None）。
 
+    if registry is not None:
+        if ok:
+            registry.record_success([ticker])
+        else:
+            registry.record_failure(ticker, data_name, last_error)
+    return ok
+
 def Redownload(redownload_txt):
     print('正在重新下载失败数据...')
 
     name = ['Shanghai_Shenzhen', 'Snp500_Ru1000', 'TSX']
 
-    global tickers
+    registry = FailureRegistry()
+    before = len(registry.failures())
+    writer = get_writer()
+    if writer:
+        # 整批入库失败时整批已丢弃，批内股票重新登记为失败，之后再重试
+        writer.on_failure = [lambda batch, error: registry.record_failures(
+            [(ticker, market, error) for ticker, market in batch.items()], error_class='storage')]
+    # 已到重试时间的股票，按优先级排序 (限流/网络错误优先，其次失败次数少的)
+    queue = registry.retry_queue()
+    print(f'待重试 {len(queue)} 只股票，登记表中共 {before} 只')
+
+    # 所有股票共用一个限速器；固定大小的线程池，失败列表再长也不会创建成百上千个线程
+    configure_session(pool_size=REDOWNLOAD_WORKERS)  # 连接池与线程数一致，连接不会被丢弃
+    limiter = AdaptiveLimiter(max_concurrency=REDOWNLOAD_WORKERS)
+    with ThreadPoolExecutor(max_workers=REDOWNLOAD_WORKERS) as pool:
+        futures = [pool.submit(downloader, ticker, market, start_date, end_date,
+                               option=download_option_method, limiter=limiter,  # 遵循下载方式选择
+                               registry=registry)
+                   for ticker, market in queue]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"下载线程异常: {e}")
+    try:
+        flush_writer()
+    except Exception as e:
+        print(f"❌ DuckDB 批量入库失败: {e}")
+    if writer:
+        writer.on_failure = []
 
+    # 重新下载后仍下载失败的数据记录 (录入 Excel 用)
     record = ''
-    # 获取下载列表
-    thread_list = list()
-
-    for n in range(0, 3):
-        pos = failedList.index(name[n])
-        try:
-            failed_count = int(failedList[pos + 1].replace('失败下载数量: ', '').strip())
-        except ValueError:
-            print(f"Invalid format in failedList[pos + 1]: {failedList[pos + 1]}")
-            failed_count = 0  # 默认值，或者根据需求处理
-
-        download_tickers = failedList[(pos + 2): (pos + 2 + failed_count)]
-
-        # 下载失败的重复5次，其余情况重复三次
-        if redownload_txt == 'failed_txt/failed.txt':
-            repeat = 5
-        else:
-            repeat = 3
-
-        while repeat > 0:
-            for ticker in download_tickers:
-                # 确保Redownload也遵循下载方式选择
-                t = threading.Thread(target=downloader, args=(ticker, name[n], start_date, end_date),
-                                     kwargs={'option': download_option_method})
-                thread_list.append(t)
-
-            for i, thread in enumerate(thread_list):
-                thread.start()  # 线程的设置
-                if i % 3 == 0:
-                    time.sleep(0.5)
-                if i != 0 and i % 100 == 0:
-                    time.sleep(10)
-            for thread in thread_list:
-                thread.join()
-
-            thread_list.clear()
-            repeat -= 1
-
-            download_tickers = fail_download[name[n]]  # 更新下载失败的股票
-            if repeat != 0:
-                fail_download[name[n]] = []
-
-        record += ('\n' + name[n] + '\n下载失败数量: ' + str(len(fail_download[name[n]])) + '\n' + '\n'.join(
-            fail_download[name[n]]) + '\n')
-
-    # 重新下载后仍下载失败的数据记录
+    for market in name:
+        failed = [row[0] for row in registry.failures(market)]
+        record += ('\n' + market + '\n下载失败数量: ' + str(len(failed)) + '\n' + '\n'.join(failed) + '\n')
+    os.makedirs(os.path.dirname(redownload_txt) or '.', exist_ok=True)
     with open(redownload_txt, 'w', encoding='utf-8') as f2:
         f2.write(record)
-    # 新旧数据对比
-    with open(redownload_txt, 'r', encoding='utf-8') as f:
-        new_failedList = f.readlines()
 
-    compare_len = (len(old_failedList) - len(new_failedList))
+    compare_len = before - len(registry.failures())
     if compare_len <= 0:
-        print('\n没有新数据，重试2-3次，然后录入Excel！')
+        print('\n没有新数据，稍后重试 (失败的股票按退避时间自动排队)，或录入Excel！')
     else:
         print('\n更新了 ' + str(compare_len) + ' 条数据！')
+    print(f'失败登记表: {registry.summary()}')
+    registry.close()
 
     print('重新下载完成！')
 
 
 def symbolNo_download(symbolNo, download_option_method=None):  # v2.7: 添加 symbolNo_download 函数，用于单个股票的下载
-    data = pd.ExcelFile('master_symbol_v1.6_2023.03.xlsx')
-    sheet_names = data.sheet_names
-    data_1 = pd.read_excel('master_symbol_v1.6_2023.03.xlsx', 2)  # Shanghai_Shenzhen
-    data_1.name = sheet_names[2]
-    data_2 = pd.read_excel('master_symbol_v1.6_2023.03.xlsx', 1)  # Snp500_Ru1000
-    data_2.name = sheet_names[1]
-    data_3 = pd.read_excel('master_symbol_v1.6_2023.03.xlsx', 3)  # TSX
-    data_3.name = sheet_names[3]
-    required_data = [data_1, data_2, data_3]
-
-    classify = None
-    # 查找symbolNo的股票种类
-    for _data in required_data:
-        for index, row in _data.iterrows():
-            if symbolNo == row[0]:  # symbolNo在表格中
-                if row['currently use'] != 'yes':  # 但不符合条件
-                    print(symbolNo + ' 目前未在使用状态！')
-                    return
-                classify = _data.name  # 如果是，则完成分类
-                break
-        if classify != None:  # 用于停止循环
-            break
+    # 查找symbolNo的股票种类 (索引缓存在本地，清单文件变化时才重新解析)
+    entry = get_symbol_index().lookup(symbolNo)
+    if entry is None:
+        print(symbolNo + ' 不在股票清单中！')
+        return
+    if not entry['active']:  # 不符合条件
+        print(symbolNo + ' 目前未在使用状态！')
+        return
 
     # 下载symbolNo股票
-    downloader(symbolNo, classify, start_date, end_date, option=download_option_method)
-
-def get_data(y, c1, c2):  # 获取待填入数据
-    for cell in total_columns[y]:
-        y_Tickers.append(cell.value)
-    for cell in total_columns[c1]:
-        content1.append(cell.value)
-    if c2 == '':
-        for cell in total_columns[7]: # 假设 c2 为空时，第 7 列（索引 6）用于空 content2
-            content2.append('')
-    else:
-        for cell in total_columns[c2]:
-            content2.append(cell.value)
-
+    downloader(symbolNo, entry['market'], start_date, end_date, option=download_option_method)
+    flush_writer()
 
 def date_Date():  # 获取当前日期
     month = str(datetime.datetime.now().month)
@@ -316,81 +326,66 @@ def date_Date():  # 获取当前日期
     return date
 
 
-def set_pos(name, sheet, fgcolor, cell3, cell4):  # 获取填入位置
-    update_time = list()
-    for cell in list(sheet.columns)[0]:
-        update_time.append(cell.value)
-    update_time.pop(0) # 移除标题行
+def parse_failed_sections(lines):
+    """把清洗后的失败文本拆成 {市场: [股票]}；格式为 市场名 / 下载失败数量: N / N 行股票"""
+    sections = {}
+    for i in range(len(lines) - 1):
+        match = re.match(r'\s*(?:下载失败|失败下载)数量:\s*(\d+)', lines[i + 1])
+        if match:
+            num = int(match.group(1))
+            sections[lines[i].strip()] = [t.strip() for t in lines[(i + 2): (i + 2 + num)]]
+    return sections
 
-    pos = failedList.index(name)  # name的位置
-    num = int(failedList[pos + 1].replace('下载失败数量: ', ''))  # 下载失败的股票数量
-    data = failedList[(pos + 2): (pos + 2 + num)]  # 下载失败的股票信息
 
-    try:
-        blank_pos = update_time.index(None) + 1 # 找到第一个空行
-    except ValueError: # 如果没有空值，表示所有单元格都已填充，则追加到末尾
-        blank_pos = len(update_time) + 1
+def _cell(row, col):
+    return row[col] if col is not None and col < len(row) else None
 
-    date = date_Date()
 
-    for i in range(0, num):
-        ticker_pos = y_Tickers.index(data[i])
-        cell_pos = 'D' + str(blank_pos + i) # 日期列
-        cell2_pos = 'A' + str(blank_pos + i) # 股票代码列
-        cell3_pos = 'B' + str(blank_pos + i) # content1列
-        cell4_pos = 'C' + str(blank_pos + i) # content2列
+def build_ticker_index(sheet, columns):
+    """一次遍历清单工作表，建立 {代码: (内容1, 内容2)}，之后每只股票 O(1) 查找"""
+    y, c1, c2 = columns
+    index = {}
+    for row in sheet.iter_rows(values_only=True):
+        ticker = _cell(row, y)
+        if ticker is not None:
+            index.setdefault(ticker, (_cell(row, c1), _cell(row, c2)))
+    return index
 
-        sheet[cell_pos] = date
-        # openpyxl.styles 模块需要导入 PatternFill
-        from openpyxl.styles import PatternFill
-        sheet[cell2_pos].fill = PatternFill(fill_type='solid', fgColor=fgcolor)
-        sheet[cell2_pos] = data[i]
-        sheet[cell3_pos] = cell3[ticker_pos]
-        sheet[cell4_pos] = cell4[ticker_pos]
 
-
-def ToExcel():
+def ToExcel(output=None):
+    """失败股票写入单独的 Excel 文件 (write-only 流式写入)，不再改写整个清单工作簿
+    每个市场一个工作表，沿用清单中 XXX Faillist 工作表的名称和表头"""
     print('正在录入Excel...')
 
-    excel = openpyxl.load_workbook('master_symbol_v1.6_2023.03.xlsx')
-    names = excel.sheetnames
-
-    global total_columns, y_Tickers, content1, content2
-    total_columns = list()
-    y_Tickers = list()
-    content1 = list()
-    content2 = list()
+    source = openpyxl.load_workbook(MASTER_XLSX, read_only=True)
+    names = source.sheetnames
+    sections = parse_failed_sections(failedList)
+    date = date_Date()
+    output = output or os.path.join(FAIL_EXCEL_DIR, f'Faillist_{date}.xlsx')
 
+    book = openpyxl.Workbook(write_only=True)
     # 遍历工作表（假设1、2、3分别对应上海/深圳、标普500/罗素1000、多伦多证券交易所）
-    for n in range(1, 4):
-        fgcolor = color[random.randint(0, 13)]
-
-        # 解析失败数据文本
-        total_sheet = excel[names[n]]
-        total_columns.clear() # 为每个工作表清除
-        for column in total_sheet.columns:
-            total_columns.append(column)
-
-        y_Tickers.clear()
-        content1.clear()
-        content2.clear()
-
-        # 根据您的Excel工作表结构调整列索引
-        if n == 1:
-            get_data(0, 1, 2)
-        elif n == 2:
-            get_data(1, 4, '')
-        elif n == 3:
-            get_data(1, 2, 5)
+    for n, columns in FAIL_COLUMNS.items():
+        index = build_ticker_index(source[names[n]], columns)
+        fill = PatternFill(fill_type='solid', fgColor=color[random.randint(0, 13)])
 
         # 假设 XXX Faillist 工作表在 names[n+5]
-        sheet = excel[names[n + 5]]
-
-        set_pos(names[n], sheet, fgcolor, content1, content2)
-
-
-    excel.save('master_symbol_v1.6_2023.03.xlsx')
-    print('\n' + '完成！')
+        fail_name = names[n + 5]
+        sheet = book.create_sheet(fail_name)
+        header = next(source[fail_name].iter_rows(max_row=1, values_only=True), None)
+        if header:
+            sheet.append(list(header))
+
+        for ticker in sections.get(names[n], []):
+            content1, content2 = index.get(ticker, (None, None))
+            ticker_cell = WriteOnlyCell(sheet, value=ticker)  # 股票代码列
+            ticker_cell.fill = fill
+            sheet.append([ticker_cell, content1, content2, date])
+
+    source.close()
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    book.save(output)
+    print('\n' + '完成！' + output)
 
 
 # 用于下载方式选择的全局变量
@@ -12,6 +12,9 @@ python 2.QC.py
 echo "开始check..."
 python 3.check.py
 
+echo "导出 Parquet..."
+python 9.export_parquet.py
+
 echo "正在迁移到数据库..."
 python 4.migrate_to_postgres.py
 
@@ -0,0 +1,111 @@
+# util/anomaly.py
+# 数据异常检测：一次窗口函数扫描整张 stock_data，按股票汇总各类异常
+from util.database_duckdb import META_TABLE, TABLE_NAME
+
+JUMP_THRESHOLD = 1.0          # 相邻两月收盘价涨跌超过 100% (翻倍或腰斩) 视为跳变
+STALE_RUN = 6                 # 连续 N 个月收盘价完全相同
+VOLUME_SPIKE = 20.0           # 成交量超过前 12 个月均值的倍数
+SPLIT_FACTORS = [2, 3, 4, 5, 8, 10, 20]
+SPLIT_TOLERANCE = 0.03        # 价格比与整数拆股比例的相对误差
+
+# 需要重新下载的异常；成交量放大、价格长期不变只在报告中列出
+RETRY_FLAGS = {'price_jump', 'non_positive_price', 'high_below_low', 'unadjusted_split', 'month_gap'}
+# 每只股票上次因异常加入重试队列时的内容哈希与最晚异常日期
+RETRY_STATE_TABLE = "anomaly_retry_state"
+
+
+def detect_anomalies(con, tickers_view=None):
+    """返回每只股票每类异常一行：Ticker, Market, Flag, Count, First_Date, Last_Date
+    tickers_view: 只检查其中的股票 (含 ticker 列的表或视图)，为空时检查全部"""
+    source = TABLE_NAME if tickers_view is None else \
+        f"(SELECT * FROM {TABLE_NAME} WHERE ticker IN (SELECT ticker FROM {tickers_view}))"
+    split_factors = ', '.join(str(k) for k in SPLIT_FACTORS)
+    return con.execute(f"""
+        WITH base AS (
+            SELECT ticker, market, "date", open, high, low, close, volume,
+                   lag(close) OVER w AS prev_close,
+                   lag("date") OVER w AS prev_date,
+                   avg(volume) OVER (PARTITION BY ticker ORDER BY "date"
+                                     ROWS BETWEEN 12 PRECEDING AND 1 PRECEDING) AS avg_volume
+            FROM {source}
+            WHERE close IS NOT NULL
+            WINDOW w AS (PARTITION BY ticker ORDER BY "date")
+        ),
+        runs AS (
+            -- 收盘价变化时开启新的分组，同组行数即连续不变的月数
+            SELECT *, sum(CASE WHEN close IS DISTINCT FROM prev_close THEN 1 ELSE 0 END)
+                          OVER (PARTITION BY ticker ORDER BY "date") AS run_id
+            FROM base
+        ),
+        rows AS (
+            SELECT *, count(*) OVER (PARTITION BY ticker, run_id) AS run_length,
+                   CASE WHEN close > 0 AND prev_close > 0
+                        THEN greatest(close / prev_close, prev_close / close) END AS ratio
+            FROM runs
+        ),
+        flags AS (
+            SELECT ticker, market, "date", unnest(list_filter([
+                CASE WHEN ratio > 1 + {JUMP_THRESHOLD} THEN 'price_jump' END,
+                CASE WHEN least(open, high, low, close) <= 0 THEN 'non_positive_price' END,
+                CASE WHEN high < low THEN 'high_below_low' END,
+                CASE WHEN run_length >= {STALE_RUN} AND close IS NOT DISTINCT FROM prev_close THEN 'stale_close' END,
+                CASE WHEN avg_volume > 0 AND volume > {VOLUME_SPIKE} * avg_volume THEN 'volume_spike' END,
+                CASE WHEN list_contains([{split_factors}], round(ratio))
+                          AND abs(ratio - round(ratio)) / round(ratio) < {SPLIT_TOLERANCE}
+                     THEN 'unadjusted_split' END,
+                CASE WHEN date_diff('month', prev_date, "date") > 1 THEN 'month_gap' END
+            ], x -> x IS NOT NULL)) AS flag
+            FROM rows
+        )
+        SELECT ticker AS Ticker, any_value(market) AS Market, flag AS Flag, count(*) AS Count,
+               strftime(min("date"), '%Y-%m-%d') AS First_Date, strftime(max("date"), '%Y-%m-%d') AS Last_Date
+        FROM flags
+        GROUP BY ticker, flag
+        ORDER BY ticker, flag
+    """).df()
+
+
+def retry_candidates(anomalies):
+    """需要重新下载的股票 [(ticker, market, 说明)]"""
+    flagged = anomalies[anomalies['Flag'].isin(RETRY_FLAGS)]
+    if flagged.empty:
+        return []
+    grouped = flagged.groupby(['Ticker', 'Market'], sort=True, dropna=False)['Flag'].agg(lambda f: ','.join(sorted(f)))
+    return [(ticker, market, f"data odd: {flags}") for (ticker, market), flags in grouped.items()]
+
+
+def pending_retries(con, anomalies):
+    """retry_candidates 中去掉不必再重下的股票，返回 [(ticker, market, 说明)]：
+    上次加入队列后内容哈希没变 (重下结果相同，说明是真实行情，例如停牌、单月翻倍)，
+    或者最晚的异常日期不晚于上次加入时 (只是追加了正常的新数据)；
+    本次加入队列的股票记录当前内容哈希与最晚异常日期"""
+    candidates = retry_candidates(anomalies)
+    if not candidates:
+        return []
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {RETRY_STATE_TABLE} (
+            ticker VARCHAR PRIMARY KEY,
+            content_hash VARCHAR,
+            last_flagged DATE,
+            queued_at TIMESTAMP
+        )
+    """)
+    flagged = anomalies[anomalies['Flag'].isin(RETRY_FLAGS)]
+    latest = flagged.groupby('Ticker', as_index=False)['Last_Date'].max()
+    con.register('_flagged_view', latest)
+    try:
+        settled = {r[0] for r in con.execute(f"""
+            SELECT f.Ticker FROM _flagged_view f
+            JOIN {RETRY_STATE_TABLE} s ON s.ticker = f.Ticker
+            LEFT JOIN {META_TABLE} m ON m.ticker = f.Ticker
+            WHERE s.content_hash = m.content_hash OR CAST(f.Last_Date AS DATE) <= s.last_flagged
+        """).fetchall()}
+        con.execute(f"""
+            INSERT OR REPLACE INTO {RETRY_STATE_TABLE}
+            SELECT f.Ticker, m.content_hash, CAST(f.Last_Date AS DATE), now()
+            FROM _flagged_view f LEFT JOIN {META_TABLE} m ON m.ticker = f.Ticker
+            WHERE NOT list_contains(?, f.Ticker)
+        """, [sorted(settled)])
+    finally:
+        con.unregister('_flagged_view')
+    return [c for c in candidates if c[0] not in settled]
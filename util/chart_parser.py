@@ -0,0 +1,59 @@
+# util/chart_parser.py
+# 把 chart 接口的 JSON 直接转换成带类型的列：int64 时间戳 -> datetime64，价格 float64，成交量可空 Int64
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson  # 可选依赖：有则使用更快的 JSON 解析
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+PRICE_FIELDS = ['open', 'high', 'low', 'close']
+
+
+class ChartDataError(ValueError):
+    """chart 接口返回了错误信息或没有结果"""
+
+
+def _float_column(values, n):
+    """None -> NaN，长度不足时补 NaN"""
+    if values and len(values) == n:
+        return np.array(values, dtype=np.float64)
+    arr = np.full(n, np.nan)
+    if values:
+        m = min(n, len(values))
+        arr[:m] = np.array(values[:m], dtype=np.float64)
+    return arr
+
+
+def parse_chart(payload):
+    """解析 chart.result[0]，返回列为 date/open/high/low/close/adj_close/volume 的 DataFrame
+    payload 可以是原始字节、字符串或已解析的 dict"""
+    if isinstance(payload, (bytes, bytearray, str)):
+        payload = loads(payload)
+
+    chart = payload.get("chart") or {}
+    if chart.get("error"):
+        raise ChartDataError(f"requests API 错误: {chart['error']}")
+    result = chart.get("result")
+    if not result:
+        raise ChartDataError("requests 未返回数据。")
+
+    result = result[0]
+    timestamps = np.array(result.get("timestamp") or [], dtype=np.int64)
+    n = len(timestamps)
+    indicators = result.get("indicators") or {}
+    quote = (indicators.get("quote") or [{}])[0] or {}
+    adjclose = (indicators.get("adjclose") or [{}])[0] or {}
+
+    columns = {"date": timestamps.astype("datetime64[s]").astype("datetime64[ns]")}
+    for field in PRICE_FIELDS:
+        columns[field] = _float_column(quote.get(field), n)
+    columns["adj_close"] = _float_column(adjclose.get("adjclose"), n)
+
+    volume = _float_column(quote.get("volume"), n)
+    mask = np.isnan(volume)
+    columns["volume"] = pd.arrays.IntegerArray(np.where(mask, 0, volume).astype(np.int64), mask)
+    return pd.DataFrame(columns)
@@ -0,0 +1,539 @@
+# util/database_duckdb.py
+# DuckDB 仓库的统一存储层：所有股票存放在一张长表 stock_data 中，按 (ticker, date) 排序
+import hashlib
+import sqlite3
+import time
+import duckdb
+import pandas as pd
+from util.month_end import to_month_end
+
+DB_PATH = "yahoo_stock_data.duckdb"
+LOCAL_DB = "yahoo_data.db"
+TABLE_NAME = "stock_data"
+VIEW_NAME = "stock_monthly_change"
+META_TABLE = "ticker_meta"
+VIEW_META_TABLE = "view_meta"
+# 月度涨跌表的计算逻辑版本，修改 refresh_monthly_change 时加一，已有的库会全表重建
+MONTHLY_CHANGE_VERSION = 1
+COUNTRIES = ['Shanghai_Shenzhen', 'Snp500_Ru1000', 'TSX']
+COLUMNS = ['ticker', 'market', 'date', 'open', 'high', 'low', 'close', 'adj_close', 'volume']
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'adj_close', 'volume']
+# 查询层对外的列名 (沿用旧版单股票表的列名，RAG 规则与图表按这些名字工作)：存储层列名 -> 对外列名
+QUERY_COLUMNS = {'ticker': 'Ticker', 'market': 'Country', 'date': 'Date', 'open': 'Open', 'high': 'High',
+                 'low': 'Low', 'close': 'Close', 'adj_close': 'Adj Close', 'volume': 'Volume'}
+# 查询连接中以只读方式挂载的主库别名
+QUERY_STORE_ALIAS = "store"
+
+# 系统自有的表/视图，迁移时不当作旧版单股票表
+SYSTEM_TABLES = {TABLE_NAME, VIEW_NAME, META_TABLE, VIEW_META_TABLE, 'download_runs', 'download_jobs', 'qc_runs',
+                 'anomaly_retry_state'}
+
+
+def to_table_name(ticker):
+    """旧版单股票表的表名规则"""
+    return ticker.lower().replace('.', '_').replace('-', '_')
+
+
+def create_stock_table(con):
+    """建表 (幂等)：数据长表 + 每只股票一行的元数据表 + 月度涨跌物化表"""
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            ticker VARCHAR NOT NULL,
+            market VARCHAR,
+            "date" DATE NOT NULL,
+            open DOUBLE,
+            high DOUBLE,
+            low DOUBLE,
+            close DOUBLE,
+            adj_close DOUBLE,
+            volume BIGINT
+        )
+    """)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {META_TABLE} (
+            ticker VARCHAR PRIMARY KEY,
+            market VARCHAR,
+            first_date DATE,
+            last_date DATE,
+            row_count BIGINT,
+            null_close BIGINT,
+            fetched_at TIMESTAMP,      -- 最近一次抓取入库的时间
+            source VARCHAR,            -- yf / API / csv ...
+            content_hash VARCHAR,      -- 全部行内容的 md5，内容没变时哈希不变
+            updated_at TIMESTAMP       -- 本行最近一次重算的时间，增量 QC 据此找出变动过的股票
+        )
+    """)
+    # 早期创建的 ticker_meta 没有 updated_at 列
+    con.execute(f"ALTER TABLE {META_TABLE} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP")
+    create_monthly_change_table(con)
+
+
+def normalize_frame(df, ticker, market):
+    """把 yfinance / requests 两种来源的 DataFrame 统一成 stock_data 的列"""
+    out = pd.DataFrame(index=df.index)
+    out['ticker'] = ticker
+    out['market'] = market
+    dates = pd.to_datetime(df['date'])
+    if dates.dt.tz is not None:
+        # yfinance 返回交易所时区，去掉时区保留当地日期
+        dates = dates.dt.tz_localize(None)
+    out['date'] = dates.dt.normalize()
+    for col in PRICE_COLUMNS:
+        out[col] = pd.to_numeric(df[col], errors='coerce') if col in df.columns else float('nan')
+    out['volume'] = out['volume'].round().astype('Int64')
+    return out.dropna(subset=['date']).reset_index(drop=True)
+
+
+class BatchWriteError(Exception):
+    """整批写入失败：该批已回滚并从缓冲区丢弃，批内股票已交给 on_failure 钩子"""
+
+    def __init__(self, tickers, error):
+        super().__init__(f"{len(tickers)} 只股票的批量写入失败: {error}")
+        self.tickers = tickers
+
+
+class StockWriter:
+    """批量写入器：在内存中缓冲多只股票，每 batch_size 只 / flush_interval 秒 / 超过内存上限时
+    在同一个事务里一次性写入 stock_data，进程中途被杀也不会留下写了一半的批次
+    month_end=True 时写入前把整批数据一次性对齐到自然月月末"""
+
+    def __init__(self, con, batch_size=200, flush_interval=30, max_buffer_mb=256, month_end=False):
+        self.con = con
+        self.month_end = month_end
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_mb * 1024 * 1024
+        self.frames = {}      # ticker -> 已统一列名的 DataFrame
+        self.since = {}       # ticker -> 增量起始日期 (None 表示替换全部历史)
+        self.until = {}       # ticker -> 替换范围的结束日期 (None 表示到最新)
+        self.sources = {}     # ticker -> 数据来源，写入 ticker_meta
+        self.markets = {}     # ticker -> 市场，失败时交给 on_failure 钩子
+        self.buffer_bytes = 0
+        self.last_flush = time.monotonic()
+        # 提交前在同一事务内调用的钩子 hook(tickers)，例如记录任务完成状态
+        self.before_commit = []
+        # 整批写入失败 (已回滚) 时调用的钩子 hook({ticker: market}, error)，例如把批内股票全部记为失败；
+        # 失败的批次不会留在缓冲区里，之后成功的批次不会把它写进去
+        self.on_failure = []
+
+    def add(self, df, ticker, market, since=None, source=None, until=None):
+        data = normalize_frame(df, ticker, market)
+        if ticker in self.frames:
+            self.buffer_bytes -= self.frames[ticker].memory_usage(deep=True).sum()
+        self.frames[ticker] = data
+        self.since[ticker] = since
+        self.until[ticker] = until
+        self.sources[ticker] = source
+        self.markets[ticker] = market
+        self.buffer_bytes += data.memory_usage(deep=True).sum()
+        if (len(self.frames) >= self.batch_size
+                or self.buffer_bytes >= self.max_buffer_bytes
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """把缓冲区写入数据库，返回写入的股票数；失败时丢弃整批、调用 on_failure 钩子后抛出 BatchWriteError"""
+        self.last_flush = time.monotonic()
+        if not self.frames:
+            return 0
+        try:
+            self._write()
+        except Exception as e:
+            batch = dict(self.markets)
+            self._clear()
+            for hook in self.on_failure:
+                hook(batch, e)
+            raise BatchWriteError(list(batch), e) from e
+        count = len(self.frames)
+        self._clear()
+        return count
+
+    def _write(self):
+        """整批数据在一个事务里写入"""
+        data = pd.concat(self.frames.values(), ignore_index=True)
+        if self.month_end:
+            data = to_month_end(data, group_col='ticker')
+        bounds = pd.DataFrame({
+            'ticker': list(self.since.keys()),
+            'since': pd.to_datetime(list(self.since.values())),
+            'until': pd.to_datetime([self.until.get(t) for t in self.since]),
+            'source': pd.Series([self.sources.get(t) for t in self.since], dtype='string'),
+            'fetched_at': pd.Timestamp.now(),
+        })
+        self.con.register('_buffer_view', data)
+        self.con.register('_bounds_view', bounds)
+        try:
+            self.con.execute("BEGIN TRANSACTION")
+            self.con.execute(f"""
+                DELETE FROM {TABLE_NAME} USING _bounds_view b
+                WHERE {TABLE_NAME}.ticker = b.ticker
+                  AND (b.since IS NULL OR {TABLE_NAME}."date" >= CAST(b.since AS DATE))
+                  AND (b.until IS NULL OR {TABLE_NAME}."date" <= CAST(b.until AS DATE))
+            """)
+            self.con.execute(f'INSERT INTO {TABLE_NAME} BY NAME SELECT * FROM _buffer_view ORDER BY ticker, "date"')
+            refresh_ticker_meta(self.con, '_bounds_view')
+            refresh_monthly_change(self.con, '_bounds_view')
+            for hook in self.before_commit:
+                hook(list(self.frames))
+            self.con.execute("COMMIT")
+        except Exception:
+            self.con.execute("ROLLBACK")
+            raise
+        finally:
+            self.con.unregister('_buffer_view')
+            self.con.unregister('_bounds_view')
+
+    def _clear(self):
+        self.frames.clear()
+        self.since.clear()
+        self.until.clear()
+        self.sources.clear()
+        self.markets.clear()
+        self.buffer_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+
+def refresh_ticker_meta(con, tickers_view=None):
+    """按 stock_data 重新计算股票的元数据 (调用方负责事务，与数据写入同一事务提交)
+    tickers_view: 含 ticker / source / fetched_at 列的表或视图，只刷新其中的股票；为空时全部重算
+    来源和抓取时间缺失时沿用原有记录"""
+    if tickers_view is None:
+        tickers_view = f"(SELECT DISTINCT ticker, NULL::VARCHAR AS source, NULL::TIMESTAMP AS fetched_at FROM {TABLE_NAME})"
+    con.execute(f"""
+        DELETE FROM {META_TABLE}
+        WHERE ticker IN (SELECT ticker FROM {tickers_view})
+          AND ticker NOT IN (SELECT ticker FROM {TABLE_NAME})
+    """)
+    con.execute(f"""
+        INSERT OR REPLACE INTO {META_TABLE}
+        SELECT d.ticker, any_value(d.market), min(d."date"), max(d."date"),
+               count(*), count(*) - count(d.close),
+               coalesce(any_value(v.fetched_at), any_value(m.fetched_at)),
+               coalesce(any_value(v.source), any_value(m.source)),
+               md5(string_agg(concat_ws('|', d."date", d.open, d.high, d.low, d.close, d.adj_close, d.volume),
+                              ',' ORDER BY d."date")),
+               now()
+        FROM {TABLE_NAME} d
+        JOIN {tickers_view} v ON d.ticker = v.ticker
+        LEFT JOIN {META_TABLE} m ON m.ticker = d.ticker
+        GROUP BY d.ticker
+    """)
+
+
+def ensure_ticker_meta(con):
+    """旧库第一次使用时由现有数据补齐 ticker_meta"""
+    create_stock_table(con)
+    missing = con.execute(f"""
+        SELECT count(*) FROM (SELECT DISTINCT ticker FROM {TABLE_NAME})
+        WHERE ticker NOT IN (SELECT ticker FROM {META_TABLE})
+    """).fetchone()[0]
+    if missing:
+        con.execute("BEGIN TRANSACTION")
+        try:
+            refresh_ticker_meta(con)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    return missing
+
+
+def get_last_dates(con, tickers=None):
+    """从 ticker_meta 取出每只股票的最新日期 {ticker: date}；只读打开的旧库没有 ticker_meta 时扫描 stock_data"""
+    has_meta = con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ?", [META_TABLE]).fetchone()[0]
+    if has_meta:
+        rows = con.execute(f'SELECT ticker, last_date FROM {META_TABLE}').fetchall()
+    else:
+        rows = con.execute(f'SELECT ticker, max("date") FROM {TABLE_NAME} GROUP BY ticker').fetchall()
+    if tickers is not None:
+        wanted = set(tickers)
+        rows = [r for r in rows if r[0] in wanted]
+    return {ticker: last_date for ticker, last_date in rows if last_date is not None}
+
+
+def load_ticker_markets(local_db=LOCAL_DB):
+    """从本地清单库读取 {旧表名: (ticker, market)}，用于还原旧版表名"""
+    mapping = {}
+    conn = sqlite3.connect(local_db)
+    try:
+        for country in COUNTRIES:
+            try:
+                rows = conn.execute(f'SELECT Yahoo_adj_Ticker_symbol FROM "{country}"').fetchall()
+            except sqlite3.Error:
+                continue
+            for (ticker,) in rows:
+                if ticker:
+                    mapping.setdefault(to_table_name(ticker), (ticker, country))
+    finally:
+        conn.close()
+    return mapping
+
+
+def guess_ticker_market(table_name):
+    """清单里找不到时，按后缀推断 ticker 与市场 (与旧版查询视图的规则一致)"""
+    if '_' in table_name:
+        parts = table_name.split('_')
+        suffix = parts[-1].lower()
+        ticker = f"{''.join(parts[:-1])}.{parts[-1]}".upper()
+        if suffix in ['sz', 'ss']:
+            return ticker, 'Shanghai_Shenzhen'
+        if suffix == 'to':
+            return ticker, 'TSX'
+        return ticker, 'Snp500_Ru1000'
+    return table_name.upper(), 'Snp500_Ru1000'
+
+
+def list_legacy_tables(con):
+    """旧版每只股票一张表的表名 (带 date / close 列的非系统表)"""
+    rows = con.execute("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'main' AND lower(column_name) IN ('date', 'close')
+        GROUP BY table_name HAVING count(*) = 2
+    """).fetchall()
+    views = {r[0] for r in con.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_type = 'VIEW'").fetchall()}
+    return [r[0] for r in rows if r[0] not in SYSTEM_TABLES and r[0] not in views]
+
+
+def migrate_ticker_tables(con, local_db=LOCAL_DB, drop_legacy=True):
+    """把旧版单股票表合并进 stock_data，整个迁移在一个事务内完成"""
+    create_stock_table(con)
+    legacy = list_legacy_tables(con)
+    if not legacy:
+        ensure_ticker_meta(con)
+        ensure_monthly_change(con)
+        return 0
+
+    try:
+        ticker_map = load_ticker_markets(local_db)
+    except sqlite3.Error:
+        ticker_map = {}
+
+    columns = {}
+    for table_name, column_name in con.execute(
+            "SELECT table_name, lower(column_name) FROM information_schema.columns WHERE table_schema = 'main'").fetchall():
+        columns.setdefault(table_name, set()).add(column_name)
+
+    print(f"🔁 发现 {len(legacy)} 张旧版单股票表，开始迁移到 {TABLE_NAME} ...")
+    con.execute("BEGIN TRANSACTION")
+    try:
+        for name in legacy:
+            cols = columns.get(name, set())
+            if 'date' not in cols:
+                continue
+            ticker, market = ticker_map.get(name) or guess_ticker_market(name)
+            select_cols = ', '.join(f'"{c}"' if c in cols else f'NULL AS {c}' for c in PRICE_COLUMNS)
+            con.execute(f"""
+                INSERT INTO {TABLE_NAME} BY NAME
+                SELECT ? AS ticker, ? AS market, CAST("date" AS DATE) AS "date", {select_cols}
+                FROM "{name}" WHERE "date" IS NOT NULL
+            """, [ticker, market])
+            if drop_legacy:
+                con.execute(f'DROP TABLE "{name}"')
+        refresh_ticker_meta(con)
+        rebuild_monthly_change(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+    compact_stock_data(con)
+    print(f"✅ 迁移完成: {len(legacy)} 张表 -> {TABLE_NAME}")
+    return len(legacy)
+
+
+def compact_stock_data(con):
+    """按 (ticker, date) 重写整张表：清理删除留下的空洞，并让 zone map 可以按 ticker 剪枝"""
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(f'CREATE OR REPLACE TEMP TABLE _stock_sorted AS SELECT * FROM {TABLE_NAME} ORDER BY ticker, "date"')
+        con.execute(f'DELETE FROM {TABLE_NAME}')
+        con.execute(f'INSERT INTO {TABLE_NAME} SELECT * FROM _stock_sorted')
+        con.execute('DROP TABLE _stock_sorted')
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def monthly_change_sql(source=TABLE_NAME):
+    """按存储层列名 (ticker / market / date / close) 计算月度涨跌的查询"""
+    return f"""
+    SELECT Ticker, Country, Month_Start_Date, Monthly_Close,
+           LAG(Monthly_Close) OVER w AS Prev_Monthly_Close,
+           Monthly_Close - LAG(Monthly_Close) OVER w AS Monthly_Change_Amt,
+           ((Monthly_Close / NULLIF(LAG(Monthly_Close) OVER w, 0)) - 1) * 100 AS Monthly_Change_Pct
+    FROM (
+        SELECT ticker AS Ticker, market AS Country,
+               CAST(date_trunc('month', "date") AS DATE) AS Month_Start_Date,
+               arg_max(close, "date") AS Monthly_Close
+        FROM {source}
+        GROUP BY ALL
+    )
+    WINDOW w AS (PARTITION BY Ticker ORDER BY Month_Start_Date)
+"""
+
+
+MONTHLY_CHANGE_SQL = monthly_change_sql()
+
+
+def create_monthly_change_view(con, source=TABLE_NAME):
+    """创建月度涨跌视图，字段与 RAG 规则中描述的保持一致 (只用于没有物化表的内存库，例如 Parquet 查询层)
+    source: 使用存储层列名的表或视图"""
+    con.execute(f"CREATE OR REPLACE VIEW {VIEW_NAME} AS {monthly_change_sql(source)}")
+
+
+def create_query_view(con, source, extra_columns=()):
+    """查询层的 stock_data 视图：存储层列名换回对外的旧列名 (QUERY_COLUMNS)，LLM 生成的 SQL 和图表都按这些列名工作
+    source: 使用存储层列名的表或视图；extra_columns: 原样附带的列 (例如 Parquet 的分区列 year)"""
+    column_list = ', '.join([f'"{col}" AS "{name}"' for col, name in QUERY_COLUMNS.items()] +
+                            [f'"{col}"' for col in extra_columns])
+    con.execute(f"CREATE OR REPLACE VIEW {TABLE_NAME} AS SELECT {column_list} FROM {source}")
+
+
+def create_monthly_change_table(con):
+    """月度涨跌物化表 (幂等)：逻辑主键 (Ticker, Month_Start_Date)，字段与视图版本一致；旧库中的同名视图会被替换"""
+    is_view = con.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ? AND table_type = 'VIEW'",
+        [VIEW_NAME]).fetchone()[0]
+    if is_view:
+        con.execute(f"DROP VIEW {VIEW_NAME}")
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {VIEW_NAME} (
+            Ticker VARCHAR NOT NULL,
+            Country VARCHAR,
+            Month_Start_Date DATE NOT NULL,
+            Monthly_Close DOUBLE,
+            Prev_Monthly_Close DOUBLE,
+            Monthly_Change_Amt DOUBLE,
+            Monthly_Change_Pct DOUBLE
+        )
+    """)
+
+
+def _monthly_bounds(bounds_view):
+    return f"""(SELECT ticker, CAST(date_trunc('month', CAST(since AS DATE)) AS DATE) AS from_month
+                FROM {bounds_view})"""
+
+
+def refresh_monthly_change(con, bounds_view=None):
+    """按 stock_data 重算月度涨跌表中变动的部分 (调用方负责事务，与数据写入同一事务提交)
+    bounds_view: 含 ticker / since 列的表或视图，只重算这些股票 since 所在月份及之后的行；
+    第一个重算月份的上月收盘价取自表中已有的上一行。为空时全表重建"""
+    if bounds_view is None:
+        con.execute(f"DELETE FROM {VIEW_NAME}")
+        bounds_view = f"(SELECT DISTINCT ticker, NULL::DATE AS since FROM {TABLE_NAME})"
+    bounds = _monthly_bounds(bounds_view)
+    con.execute(f"""
+        DELETE FROM {VIEW_NAME} USING {bounds} b
+        WHERE {VIEW_NAME}.Ticker = b.ticker
+          AND (b.from_month IS NULL OR {VIEW_NAME}.Month_Start_Date >= b.from_month)
+    """)
+    con.execute(f"""
+        INSERT INTO {VIEW_NAME}
+        WITH b AS {bounds},
+        monthly AS (
+            SELECT d.ticker AS Ticker, any_value(d.market) AS Country,
+                   CAST(date_trunc('month', d."date") AS DATE) AS Month_Start_Date,
+                   arg_max(d.close, d."date") AS Monthly_Close, FALSE AS is_seed
+            FROM {TABLE_NAME} d JOIN b ON d.ticker = b.ticker
+            WHERE b.from_month IS NULL OR d."date" >= b.from_month
+            GROUP BY d.ticker, Month_Start_Date
+        ),
+        seed AS (
+            SELECT m.Ticker, m.Country, m.Month_Start_Date, m.Monthly_Close, TRUE AS is_seed
+            FROM {VIEW_NAME} m JOIN b ON m.Ticker = b.ticker
+            WHERE m.Month_Start_Date < b.from_month
+            QUALIFY row_number() OVER (PARTITION BY m.Ticker ORDER BY m.Month_Start_Date DESC) = 1
+        ),
+        changes AS (
+            SELECT Ticker, Country, Month_Start_Date, Monthly_Close, is_seed,
+                   LAG(Monthly_Close) OVER w AS Prev_Monthly_Close,
+                   Monthly_Close - LAG(Monthly_Close) OVER w AS Monthly_Change_Amt,
+                   ((Monthly_Close / NULLIF(LAG(Monthly_Close) OVER w, 0)) - 1) * 100 AS Monthly_Change_Pct
+            FROM (SELECT * FROM monthly UNION ALL SELECT * FROM seed)
+            WINDOW w AS (PARTITION BY Ticker ORDER BY Month_Start_Date)
+        )
+        SELECT Ticker, Country, Month_Start_Date, Monthly_Close,
+               Prev_Monthly_Close, Monthly_Change_Amt, Monthly_Change_Pct
+        FROM changes
+        WHERE NOT is_seed
+        ORDER BY Ticker, Month_Start_Date
+    """)
+
+
+def monthly_change_fingerprint(con):
+    """月度表计算逻辑 + stock_data 列结构的哈希，两者都没变时已有的物化结果仍然有效"""
+    columns = con.execute("""
+        SELECT string_agg(column_name || ' ' || data_type, ',' ORDER BY ordinal_position)
+        FROM information_schema.columns WHERE table_name = ?
+    """, [TABLE_NAME]).fetchone()[0]
+    return hashlib.md5(f"{MONTHLY_CHANGE_VERSION}|{columns}".encode('utf-8')).hexdigest()
+
+
+def monthly_change_current(con):
+    """库中的月度涨跌表是否存在且由当前逻辑完整生成 (只读连接也可调用)"""
+    tables = {r for r in con.execute(
+        "SELECT table_name, table_type FROM information_schema.tables WHERE table_name IN (?, ?)",
+        [VIEW_NAME, VIEW_META_TABLE]).fetchall()}
+    if tables != {(VIEW_NAME, 'BASE TABLE'), (VIEW_META_TABLE, 'BASE TABLE')}:
+        return False
+    row = con.execute(f"SELECT fingerprint FROM {VIEW_META_TABLE} WHERE view_name = ?", [VIEW_NAME]).fetchone()
+    return row is not None and row[0] == monthly_change_fingerprint(con)
+
+
+def rebuild_monthly_change(con):
+    """全表重建月度涨跌表并记录指纹 (调用方负责事务)"""
+    create_monthly_change_table(con)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {VIEW_META_TABLE} (
+            view_name VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR,
+            created_at TIMESTAMP
+        )
+    """)
+    refresh_monthly_change(con)
+    con.execute(f"INSERT OR REPLACE INTO {VIEW_META_TABLE} VALUES (?, ?, now())",
+                [VIEW_NAME, monthly_change_fingerprint(con)])
+
+
+def ensure_monthly_change(con):
+    """旧库第一次使用或计算逻辑变化时全表重建月度涨跌表，返回是否重建；之后由写入路径增量维护"""
+    create_stock_table(con)
+    if monthly_change_current(con):
+        return False
+    con.execute("BEGIN TRANSACTION")
+    try:
+        rebuild_monthly_change(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return True
+
+
+def connect_query_db(db_path=DB_PATH):
+    """查询用连接：内存库 + 只读挂载主库 (可与其他只读进程并发)，对外提供旧列名的 stock_data 视图和月度涨跌表；
+    月度涨跌表缺失或过期时先用读写连接重建一次。库中还没有 stock_data 时不建视图，由调用方提示"""
+    with duckdb.connect(db_path, read_only=True) as check:
+        has_table = check.execute("SELECT count(*) FROM information_schema.tables WHERE table_name = ?",
+                                  [TABLE_NAME]).fetchone()[0]
+        current = has_table and monthly_change_current(check)
+    if has_table and not current:
+        with duckdb.connect(db_path) as rw:
+            ensure_monthly_change(rw)
+
+    con = duckdb.connect()
+    con.execute(f"ATTACH '{db_path}' AS {QUERY_STORE_ALIAS} (READ_ONLY)")
+    if has_table:
+        create_query_view(con, f"{QUERY_STORE_ALIAS}.{TABLE_NAME}")
+        con.execute(f"CREATE VIEW {VIEW_NAME} AS SELECT * FROM {QUERY_STORE_ALIAS}.{VIEW_NAME}")
+    return con
@@ -0,0 +1,173 @@
+# util/failure_registry.py
+# 下载失败登记表：记录每只股票的失败原因、HTTP 状态码、失败次数与下次可重试时间，
+# 重试队列按优先级从表中取出；多次确认无数据的股票标记为 dead，之后的下载直接跳过
+# 使用 SQLite (WAL)，分片进程/多个 Pod 可以同时写入
+import datetime
+import os
+import sqlite3
+import threading
+from util.chart_parser import ChartDataError
+from util.yahoo_client import CacheMissError, YahooHTTPError
+
+FAILURE_DB = os.getenv("FAILURE_DB", "download_failures.db")
+FAILURE_TABLE = "download_failures"
+
+# 各类错误首次重试的等待时间 (秒)，之后每次翻倍，最长 MAX_BACKOFF
+RETRY_BASE = {
+    'throttled': 10 * 60,
+    'network': 30 * 60,
+    'other': 3600,
+    'data_odd': 0,             # QC 发现的数据异常，立即进入重试队列
+    'storage': 10 * 60,        # 下载成功但入库失败 (库被锁、磁盘满等)，与股票本身无关
+    'no_data': 24 * 3600,
+    'not_found': 24 * 3600,
+}
+MAX_BACKOFF = 7 * 24 * 3600
+MAX_ATTEMPTS = 10         # 任何错误 (入库失败除外) 累计失败次数达到上限 -> dead
+DEAD_AFTER_NO_DATA = 4    # 无数据/404 连续失败次数达到上限 -> dead
+# 重试优先级：暂时性错误优先
+PRIORITY = {'throttled': 0, 'network': 1, 'storage': 1, 'data_odd': 2, 'other': 2, 'no_data': 3, 'not_found': 3}
+
+
+def classify_error(error):
+    """返回 (错误类别, HTTP 状态码)"""
+    if error is None or isinstance(error, str):
+        return 'no_data', None
+    if isinstance(error, YahooHTTPError):
+        code = error.status_code
+        if code == 429 or code >= 500:
+            return 'throttled', code
+        if code == 404:
+            return 'not_found', code
+        return 'other', code
+    if isinstance(error, CacheMissError):
+        return 'other', None
+    if isinstance(error, ChartDataError):
+        return 'no_data', None
+    text = f"{type(error).__name__}: {error}"
+    if 'Too Many Requests' in text or 'RateLimit' in text:
+        return 'throttled', 429
+    if 'delisted' in text or 'No data found' in text:
+        return 'no_data', None
+    if any(k in type(error).__name__ for k in ('Connection', 'Timeout', 'SSL')):
+        return 'network', None
+    return 'other', None
+
+
+class FailureRegistry:
+    """失败登记表 (线程安全)"""
+
+    def __init__(self, path=FAILURE_DB):
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {FAILURE_TABLE} (
+                    ticker TEXT PRIMARY KEY,
+                    market TEXT,
+                    error_class TEXT,
+                    http_status INTEGER,
+                    last_error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    first_failed_at TEXT,
+                    last_failed_at TEXT,
+                    next_eligible_at TEXT,
+                    status TEXT NOT NULL DEFAULT 'retry'   -- retry / dead
+                )
+            """)
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_failures_queue ON {FAILURE_TABLE} (status, next_eligible_at)")
+            self.conn.commit()
+
+    def record_failure(self, ticker, market, error, error_class=None):
+        """登记一次失败：次数 +1，按错误类别指数退避计算下次可重试时间"""
+        self.record_failures([(ticker, market, error)], error_class)
+
+    def record_failures(self, items, error_class=None):
+        """批量登记 [(ticker, market, error)]，一次提交；error_class 为空时按异常自动分类"""
+        with self.lock:
+            for ticker, market, error in items:
+                self._upsert(ticker, market, error, error_class)
+            self.conn.commit()
+
+    def _upsert(self, ticker, market, error, error_class=None):
+        if error_class:
+            http_status = None
+        else:
+            error_class, http_status = classify_error(error)
+        now = datetime.datetime.now()
+        row = self.conn.execute(
+            f"SELECT attempts FROM {FAILURE_TABLE} WHERE ticker = ?", [ticker]).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        delay = min(MAX_BACKOFF, RETRY_BASE[error_class] * 2 ** (attempts - 1))
+        # 入库失败不说明股票没有数据，永远不会因此标记为 dead
+        dead = error_class != 'storage' and (attempts >= MAX_ATTEMPTS or (
+            error_class in ('no_data', 'not_found') and attempts >= DEAD_AFTER_NO_DATA))
+        self.conn.execute(f"""
+            INSERT INTO {FAILURE_TABLE} (ticker, market, error_class, http_status, last_error, attempts,
+                                         first_failed_at, last_failed_at, next_eligible_at, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ticker) DO UPDATE SET
+                market = excluded.market, error_class = excluded.error_class,
+                http_status = excluded.http_status, last_error = excluded.last_error,
+                attempts = excluded.attempts, last_failed_at = excluded.last_failed_at,
+                next_eligible_at = excluded.next_eligible_at, status = excluded.status
+        """, [ticker, market, error_class, http_status, str(error or '无数据')[:500], attempts,
+              now.isoformat(' '), now.isoformat(' '),
+              (now + datetime.timedelta(seconds=delay)).isoformat(' '), 'dead' if dead else 'retry'])
+
+    def record_success(self, tickers, partial=()):
+        """下载成功的股票移出登记表 (包括曾被标记为 dead 的)
+        partial: 其中只抓取了最近一段 (增量) 的股票，没有重新下载 QC 标记的月份，保留它们的 data_odd 记录"""
+        tickers = list(tickers)
+        if not tickers:
+            return
+        partial = set(partial)
+        with self.lock:
+            self.conn.executemany(f"DELETE FROM {FAILURE_TABLE} WHERE ticker = ?",
+                                  [[t] for t in tickers if t not in partial])
+            self.conn.executemany(f"DELETE FROM {FAILURE_TABLE} WHERE ticker = ? AND error_class <> 'data_odd'",
+                                  [[t] for t in tickers if t in partial])
+            self.conn.commit()
+
+    def retry_queue(self, market=None, limit=None, ignore_schedule=False):
+        """按优先级返回待重试的 [(ticker, market)]：暂时性错误优先，其次失败次数少、失败时间早的"""
+        sql = f"SELECT ticker, market FROM {FAILURE_TABLE} WHERE status = 'retry'"
+        params = []
+        if not ignore_schedule:
+            sql += " AND next_eligible_at <= ?"
+            params.append(datetime.datetime.now().isoformat(' '))
+        if market:
+            sql += " AND market = ?"
+            params.append(market)
+        order = ' '.join(f"WHEN '{k}' THEN {v}" for k, v in PRIORITY.items())
+        sql += f" ORDER BY CASE error_class {order} ELSE 9 END, attempts, last_failed_at"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def dead_tickers(self, market=None):
+        sql = f"SELECT ticker FROM {FAILURE_TABLE} WHERE status = 'dead'"
+        params = [market] if market else []
+        if market:
+            sql += " AND market = ?"
+        with self.lock:
+            return {r[0] for r in self.conn.execute(sql, params).fetchall()}
+
+    def failures(self, market=None):
+        """仍在登记表中的股票 (retry + dead)，按市场、股票排序"""
+        sql = f"SELECT ticker, market, status, error_class, attempts FROM {FAILURE_TABLE}"
+        params = [market] if market else []
+        if market:
+            sql += " WHERE market = ?"
+        with self.lock:
+            return self.conn.execute(sql + " ORDER BY market, ticker", params).fetchall()
+
+    def summary(self):
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT status, error_class, count(*) FROM {FAILURE_TABLE} GROUP BY 1, 2 ORDER BY 1, 2").fetchall()
+
+    def close(self):
+        self.conn.close()
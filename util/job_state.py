@@ -0,0 +1,123 @@
+# util/job_state.py
+# 下载任务的断点续传状态：每次运行一条 download_runs 记录，每只股票一条 download_jobs 记录
+import datetime
+import json
+import pandas as pd
+
+RUNS_TABLE = "download_runs"
+JOBS_TABLE = "download_jobs"
+
+
+def create_job_tables(con):
+    """建表 (幂等)"""
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {RUNS_TABLE} (
+            run_id VARCHAR PRIMARY KEY,
+            params VARCHAR,
+            status VARCHAR,            -- running / finished
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+            run_id VARCHAR,
+            ticker VARCHAR,
+            market VARCHAR,
+            status VARCHAR,            -- pending / done / failed
+            attempts INTEGER DEFAULT 0,
+            last_error VARCHAR,
+            updated_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (run_id, ticker)
+        )
+    """)
+
+
+class DownloadJob:
+    """一次下载运行的状态。进程重启后用相同参数启动会续上最近一次未完成的运行，
+    只重跑其中 pending / failed 的股票；params 应包含目标月份等区分不同批次的字段"""
+
+    def __init__(self, con, run_id):
+        self.con = con
+        self.run_id = run_id
+
+    @classmethod
+    def start(cls, con, params, resume=True):
+        create_job_tables(con)
+        params_json = json.dumps(params, sort_keys=True)
+        if resume:
+            row = con.execute(f"""
+                SELECT run_id FROM {RUNS_TABLE}
+                WHERE status = 'running' AND params = ?
+                ORDER BY started_at DESC LIMIT 1
+            """, [params_json]).fetchone()
+            if row:
+                print(f"♻️ 续传未完成的下载任务: {row[0]}")
+                return cls(con, row[0])
+
+        now = datetime.datetime.now()
+        run_id = now.strftime('%Y%m%d_%H%M%S_%f')
+        con.execute(f"INSERT INTO {RUNS_TABLE} VALUES (?, ?, 'running', ?, NULL)", [run_id, params_json, now])
+        return cls(con, run_id)
+
+    def register(self, tickers, market):
+        """登记本次要处理的股票；续传时已登记的保持原状态"""
+        if not tickers:
+            return
+        self.con.register('_jobs_view', pd.DataFrame({'ticker': list(dict.fromkeys(tickers))}))
+        try:
+            self.con.execute(f"""
+                INSERT INTO {JOBS_TABLE} (run_id, ticker, market, status, attempts, updated_at)
+                SELECT ?, ticker, ?, 'pending', 0, now() FROM _jobs_view
+                ON CONFLICT DO NOTHING
+            """, [self.run_id, market])
+        finally:
+            self.con.unregister('_jobs_view')
+
+    def remaining(self, market):
+        """本次运行中尚未成功的股票 (pending / failed)"""
+        rows = self.con.execute(f"""
+            SELECT ticker FROM {JOBS_TABLE}
+            WHERE run_id = ? AND market = ? AND status <> 'done'
+            ORDER BY ticker
+        """, [self.run_id, market]).fetchall()
+        return [r[0] for r in rows]
+
+    def mark_done(self, tickers):
+        """标记成功；由 StockWriter 在写入数据的同一事务里调用"""
+        if not tickers:
+            return
+        self.con.execute(f"""
+            UPDATE {JOBS_TABLE}
+            SET status = 'done', attempts = attempts + 1, last_error = NULL,
+                updated_at = now(), completed_at = now()
+            WHERE run_id = ? AND list_contains(?, ticker)
+        """, [self.run_id, list(tickers)])
+
+    def mark_batch_failed(self, tickers, error):
+        """整批入库失败：批内股票全部标记为失败；由 StockWriter 的 on_failure 钩子调用"""
+        if not tickers:
+            return
+        self.con.execute(f"""
+            UPDATE {JOBS_TABLE}
+            SET status = 'failed', attempts = attempts + 1, last_error = ?, updated_at = now()
+            WHERE run_id = ? AND list_contains(?, ticker)
+        """, [str(error)[:500], self.run_id, list(tickers)])
+
+    def mark_failed(self, ticker, error):
+        self.con.execute(f"""
+            UPDATE {JOBS_TABLE}
+            SET status = 'failed', attempts = attempts + 1, last_error = ?, updated_at = now()
+            WHERE run_id = ? AND ticker = ?
+        """, [str(error)[:500], self.run_id, ticker])
+
+    def summary(self):
+        return dict(self.con.execute(f"""
+            SELECT status, count(*) FROM {JOBS_TABLE} WHERE run_id = ? GROUP BY status
+        """, [self.run_id]).fetchall())
+
+    def finish(self):
+        self.con.execute(f"""
+            UPDATE {RUNS_TABLE} SET status = 'finished', finished_at = now() WHERE run_id = ?
+        """, [self.run_id])
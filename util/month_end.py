@@ -0,0 +1,44 @@
+# util/month_end.py
+# 日线/月线 -> 自然月月线：每个 (股票, 月份) 聚合成一根月线 (开盘取第一条、最高/最低取极值、成交量求和、收盘取最后一条)，
+# 日期统一改为当月最后一天
+import numpy as np
+import pandas as pd
+
+# 按列名 (不区分大小写) 的聚合方式；其余列 (收盘价、复权价等) 取当月最后一条
+AGG_RULES = {'open': 'first', 'high': 'max', 'low': 'min', 'volume': 'sum'}
+
+
+def to_month_end(df, date_col='date', price_col='close', group_col=None):
+    """向量化的月线聚合，一次调用可处理多只股票 (group_col 指定股票列)
+    date_col 需为不带时区的日期；没有有效收盘价的月份不会凭空补出来；
+    尚未结束的月份保留最后一条的实际日期，不写入未来的月末日期"""
+    data = df[df[price_col].notna()]
+    if data.empty:
+        return data.reset_index(drop=True)
+
+    sort_cols = [group_col, date_col] if group_col else [date_col]
+    data = data.sort_values(sort_cols, kind='mergesort')
+
+    months = data[date_col].to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+    boundary = months[1:] != months[:-1]
+    if group_col:
+        codes = pd.factorize(data[group_col])[0]
+        boundary |= codes[1:] != codes[:-1]
+    is_last = np.append(boundary, True)
+    segments = np.concatenate([[0], np.cumsum(boundary)])
+
+    out = data[is_last].copy()
+    grouped = data.groupby(segments, sort=False)
+    for col in data.columns:
+        rule = AGG_RULES.get(str(col).lower())
+        if rule == 'sum':
+            out[col] = grouped[col].sum(min_count=1).to_numpy()
+        elif rule:
+            out[col] = grouped[col].agg(rule).to_numpy()
+
+    last_dates = out[date_col].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    month_end = (months[is_last] + 1).astype('datetime64[D]') - np.timedelta64(1, 'D')
+    today = np.datetime64(pd.Timestamp.today().date(), 'D')
+    month_end = np.where(month_end > today, last_dates, month_end)
+    out[date_col] = month_end.astype('datetime64[ns]')
+    return out.reset_index(drop=True)
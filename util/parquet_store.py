@@ -0,0 +1,98 @@
+# util/parquet_store.py
+# Parquet 导出层：stock_data 按 market / year 写成 Hive 分区目录，分区内按 (ticker, date) 排序，
+# 行组带 min/max 统计；每次导出是一个新的版本目录，由指针文件 CURRENT 切换
+# 查询方直接读 Parquet，按市场/年份剪枝，不需要打开 (也不会锁住) DuckDB 主库
+import os
+import shutil
+import time
+import duckdb
+from util.database_duckdb import COLUMNS, TABLE_NAME, create_monthly_change_view, create_query_view
+
+PARQUET_DIR = os.getenv("PARQUET_DIR", "parquet")
+# 查询层设置该变量后改为读取 Parquet 导出层
+QUERY_PARQUET_DIR = os.getenv("QUERY_PARQUET_DIR")
+ROW_GROUP_SIZE = 122880
+# 指针文件：内容为当前版本目录名
+CURRENT_FILE = "CURRENT"
+# 按存储层列名读取 Parquet 的内部视图，对外的 stock_data / 月度涨跌视图都建在它上面
+PARQUET_VIEW = "stock_data_parquet"
+
+
+def parquet_glob(parquet_dir=PARQUET_DIR):
+    return os.path.join(parquet_dir, '**', '*.parquet').replace('\\', '/')
+
+
+def current_version_dir(parquet_dir=PARQUET_DIR):
+    """读取指针文件 CURRENT，返回当前版本目录；尚未导出过时返回 None"""
+    try:
+        with open(os.path.join(parquet_dir, CURRENT_FILE), encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(parquet_dir, version) if version else None
+
+
+def _swap_pointer(parquet_dir, version):
+    """先写临时文件再 os.replace，读取方看到的指针要么是旧版本要么是新版本"""
+    tmp_path = os.path.join(parquet_dir, CURRENT_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(parquet_dir, CURRENT_FILE))
+
+
+def export_parquet(con, parquet_dir=PARQUET_DIR):
+    """每次全量导出到新的版本目录，写完后原子替换指针文件；已发布的版本目录不会被改写，
+    读取方每次连接解析一次指针，只会看到完整的某个版本。保留上一个版本给仍在读取的查询，更早的版本删除；返回导出行数"""
+    os.makedirs(parquet_dir, exist_ok=True)
+    previous = current_version_dir(parquet_dir)
+    version = f"v{time.time_ns()}"
+    version_dir = os.path.join(parquet_dir, version)
+
+    column_list = ', '.join(f'"{col}"' for col in COLUMNS)
+    con.execute(f"""
+        COPY (
+            SELECT {column_list}, year("date") AS year FROM {TABLE_NAME}
+            ORDER BY market, year, ticker, "date"
+        ) TO '{version_dir}' (FORMAT PARQUET, PARTITION_BY (market, year), COMPRESSION ZSTD,
+                              ROW_GROUP_SIZE {ROW_GROUP_SIZE})
+    """)
+    rows = con.execute(f"SELECT count(*) FROM read_parquet('{parquet_glob(version_dir)}')").fetchone()[0]
+    _swap_pointer(parquet_dir, version)
+
+    # 旧版平铺布局 (market=*) 和中断导出留下的目录也一并清理
+    keep = {version, os.path.basename(previous) if previous else None}
+    for entry in os.listdir(parquet_dir):
+        path = os.path.join(parquet_dir, entry)
+        if entry not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    return rows
+
+
+def create_parquet_view(con, parquet_dir=PARQUET_DIR):
+    """在 con 上建视图指向当前版本的 Parquet：对外的 stock_data 使用旧列名 (与 connect_query_db 一致)，
+    另带分区列 year，按 year = 2025 过滤时只读对应年份的分区；同时建月度涨跌视图"""
+    version_dir = current_version_dir(parquet_dir)
+    if version_dir is None or not os.path.isdir(version_dir):
+        raise FileNotFoundError(f"Parquet 导出目录不存在: {parquet_dir}，请先运行 9.export_parquet.py")
+    column_list = ', '.join(f'"{col}"' for col in COLUMNS)
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {PARQUET_VIEW} AS
+        SELECT {column_list}, year
+        FROM read_parquet('{parquet_glob(version_dir)}', hive_partitioning = true,
+                          hive_types = {{'market': VARCHAR, 'year': INTEGER}})
+    """)
+    create_query_view(con, PARQUET_VIEW, extra_columns=['year'])
+    create_monthly_change_view(con, PARQUET_VIEW)
+
+
+def connect_parquet(parquet_dir=PARQUET_DIR):
+    """内存库 + Parquet 视图，供只读查询使用；指针在连接时解析一次，之后的导出不影响这个连接"""
+    con = duckdb.connect()
+    try:
+        create_parquet_view(con, parquet_dir)
+    except Exception:
+        con.close()
+        raise
+    return con
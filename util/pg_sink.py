@@ -0,0 +1,222 @@
+# util/pg_sink.py
+# PostgreSQL 批量写入：连接池 + 二进制 COPY 写入 UNLOGGED 中转表，每批一次 INSERT ... ON CONFLICT 合并进目标表
+# 连接参数取自 PG_DSN，为空时使用 libpq 的 PGHOST / PGPORT / PGUSER / PGPASSWORD / PGDATABASE
+# 目标表与 DuckDB 长表同构 (小写列名，主键 ticker + date)；旧版按其他列布局建的同名表不会被改动，
+# create_target_table 会直接报错，需改用新的 PG_TABLE 或先迁移旧表
+import io
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from psycopg2.pool import ThreadedConnectionPool
+from util.database_duckdb import COLUMNS, TABLE_NAME, VIEW_NAME
+
+PG_DSN = os.getenv("PG_DSN", "")
+PG_TABLE = os.getenv("PG_TABLE", TABLE_NAME)
+PG_VIEW = os.getenv("PG_VIEW", VIEW_NAME)
+PG_POOL_SIZE = int(os.getenv("PG_POOL_SIZE", 4))
+BATCH_ROWS = 200_000
+
+# 列类型，顺序与 COLUMNS 一致
+PG_TYPES = {'ticker': 'TEXT', 'market': 'TEXT', 'date': 'DATE', 'open': 'DOUBLE PRECISION',
+            'high': 'DOUBLE PRECISION', 'low': 'DOUBLE PRECISION', 'close': 'DOUBLE PRECISION',
+            'adj_close': 'DOUBLE PRECISION', 'volume': 'BIGINT'}
+
+_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_TRAILER = struct.pack('!h', -1)
+_NULL = struct.pack('!i', -1)
+_PG_EPOCH = np.datetime64('2000-01-01', 'D')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """进程内共享的连接池"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(1, PG_POOL_SIZE, PG_DSN)
+        return _pool
+
+
+@contextmanager
+def pooled_connection():
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def staging_table(table=PG_TABLE):
+    return f"{table}_staging"
+
+
+def _check_existing_table(cur, table):
+    """已存在的同名表必须与 PG_TYPES 列一致且 (ticker, date) 唯一，否则 COPY / ON CONFLICT 会在写入时才失败"""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, [table])
+    existing = {row[0] for row in cur.fetchall()}
+    if not existing:
+        return
+    if existing != set(PG_TYPES):
+        raise ValueError(f"PostgreSQL 表 {table} 已存在但列不匹配: {sorted(existing)}，"
+                         f"期望 {list(PG_TYPES)}；请设置新的 PG_TABLE 或先迁移旧表")
+    cur.execute("""
+        SELECT count(*) FROM pg_index i
+        WHERE i.indrelid = %s::regclass AND i.indisunique
+          AND (SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute a
+               WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)) = ARRAY['date', 'ticker']
+    """, [table])
+    if not cur.fetchone()[0]:
+        raise ValueError(f"PostgreSQL 表 {table} 缺少 (ticker, date) 主键，无法 UPSERT")
+
+
+def create_target_table(table=PG_TABLE):
+    """建目标表和中转表 (幂等)；中转表不写 WAL，每批数据在合并后即删除"""
+    columns = ',\n'.join(f'"{col}" {typ}' for col, typ in PG_TYPES.items())
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            _check_existing_table(cur, table)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    {columns},
+                    PRIMARY KEY (ticker, "date")
+                )
+            """)
+            cur.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {staging_table(table)} (LIKE {table})")
+
+
+def create_monthly_change_view(table=PG_TABLE, view=PG_VIEW):
+    """在目标表上建月度涨跌视图，字段与 DuckDB 的 stock_monthly_change 一致 (未加引号，列名折叠为小写)"""
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            cur.execute(f"DROP VIEW IF EXISTS {view}")
+            cur.execute(f"""
+                CREATE VIEW {view} AS
+                SELECT Ticker, Country, Month_Start_Date, Monthly_Close,
+                       LAG(Monthly_Close) OVER w AS Prev_Monthly_Close,
+                       Monthly_Close - LAG(Monthly_Close) OVER w AS Monthly_Change_Amt,
+                       ((Monthly_Close / NULLIF(LAG(Monthly_Close) OVER w, 0)) - 1) * 100 AS Monthly_Change_Pct
+                FROM (
+                    SELECT DISTINCT ON (ticker, date_trunc('month', "date"))
+                           ticker AS Ticker, market AS Country,
+                           CAST(date_trunc('month', "date") AS DATE) AS Month_Start_Date,
+                           close AS Monthly_Close
+                    FROM {table}
+                    WHERE close IS NOT NULL
+                    ORDER BY ticker, date_trunc('month', "date"), "date" DESC
+                ) AS monthly
+                WINDOW w AS (PARTITION BY Ticker ORDER BY Month_Start_Date)
+            """)
+
+
+def _encode_column(values, kind):
+    """一列 -> 每行的 [长度 + 内容] 字节串，空值写 -1"""
+    if kind == 'TEXT':
+        out = []
+        for v, missing in zip(values.tolist(), values.isna().tolist()):
+            if missing:
+                out.append(_NULL)
+            else:
+                b = str(v).encode('utf-8')
+                out.append(struct.pack('!i', len(b)) + b)
+        return out
+    if kind == 'DATE':
+        dates = pd.to_datetime(values).to_numpy(dtype='datetime64[D]')
+        days = (dates - _PG_EPOCH).astype('int64')
+        null = np.isnat(dates)
+        return [_NULL if n else struct.pack('!ii', 4, int(d)) for d, n in zip(days, null)]
+    if kind == 'BIGINT':
+        ints = pd.to_numeric(values, errors='coerce').round().astype('Int64')
+        return [_NULL if v is pd.NA else struct.pack('!iq', 8, int(v)) for v in ints]
+    floats = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64')
+    return [_NULL if np.isnan(v) else struct.pack('!id', 8, v) for v in floats]
+
+
+def encode_copy_binary(df):
+    """按 COLUMNS 顺序把 DataFrame 编码成 COPY ... (FORMAT binary) 的数据流"""
+    encoded = [_encode_column(df[col].reset_index(drop=True), PG_TYPES[col]) for col in COLUMNS]
+    row_head = struct.pack('!h', len(COLUMNS))
+    buf = io.BytesIO()
+    buf.write(_COPY_HEADER)
+    for fields in zip(*encoded):
+        buf.write(row_head)
+        buf.write(b''.join(fields))
+    buf.write(_COPY_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def write_batch(df, table=PG_TABLE):
+    """一批数据在一个事务里：COPY 进中转表 -> 一次 INSERT ... ON CONFLICT 合并 -> 清空本批中转数据
+    中转表里其他事务未提交的数据互不可见，多个连接可以并发写入"""
+    if df.empty:
+        return 0
+    staging = staging_table(table)
+    column_list = ', '.join(f'"{col}"' for col in COLUMNS)
+    updates = ', '.join(f'"{col}" = EXCLUDED."{col}"' for col in COLUMNS if col not in ('ticker', 'date'))
+    data = encode_copy_binary(df)
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            cur.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT binary)", data)
+            # 同一批内重复的 (ticker, date) 只保留一行，否则 ON CONFLICT 会报错
+            cur.execute(f"""
+                INSERT INTO {table} ({column_list})
+                SELECT DISTINCT ON (ticker, "date") {column_list} FROM {staging}
+                ORDER BY ticker, "date"
+                ON CONFLICT (ticker, "date") DO UPDATE SET {updates}
+            """)
+            cur.execute(f"DELETE FROM {staging}")
+    return len(df)
+
+
+def write_batches(batches, table=PG_TABLE, workers=PG_POOL_SIZE):
+    """并发写入多批 DataFrame (每个线程从连接池取一个连接)，返回总行数并打印吞吐"""
+    start = time.time()
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for batch in batches:
+            pending.append(executor.submit(write_batch, batch, table))
+            # 限制在途批次，避免一次把全部数据读进内存
+            if len(pending) >= workers * 2:
+                total += pending.pop(0).result()
+        for future in pending:
+            total += future.result()
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"🐘 PostgreSQL 写入 {total} 行，用时 {elapsed:.1f}s ({total / elapsed:,.0f} 行/秒)")
+    return total
+
+
+def write_frame(df, table=PG_TABLE, batch_rows=BATCH_ROWS, workers=PG_POOL_SIZE):
+    """把含 COLUMNS 列的 DataFrame 分批写入"""
+    return write_batches((df.iloc[i:i + batch_rows] for i in range(0, len(df), batch_rows)), table, workers)
+
+
+def sync_from_duckdb(con, table=PG_TABLE, tickers=None, batch_rows=BATCH_ROWS, workers=PG_POOL_SIZE):
+    """把 DuckDB 仓库的 stock_data (或其中部分股票) 流式同步到 PostgreSQL"""
+    column_list = ', '.join(f'"{col}"' for col in COLUMNS)
+    sql = f'SELECT {column_list} FROM {TABLE_NAME}'
+    params = []
+    if tickers is not None:
+        sql += ' WHERE ticker IN (SELECT unnest(?::VARCHAR[]))'
+        params.append(list(tickers))
+    reader = con.execute(sql + ' ORDER BY ticker, "date"', params).fetch_record_batch(batch_rows)
+    return write_batches((batch.to_pandas() for batch in reader), table, workers)
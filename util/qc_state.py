@@ -0,0 +1,54 @@
+# util/qc_state.py
+# QC 运行记录：每次 QC 一条 qc_runs 记录，增量 QC 只检查上次成功运行之后 ticker_meta 有变动的股票
+import datetime
+from util.database_duckdb import META_TABLE
+
+QC_RUNS_TABLE = "qc_runs"
+# 水位线往前留出余量：QC 开始前已开始、之后才提交的写入事务也能被下一次增量 QC 覆盖
+WATERMARK_MARGIN = datetime.timedelta(minutes=2)
+
+
+def create_qc_table(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {QC_RUNS_TABLE} (
+            run_id VARCHAR PRIMARY KEY,
+            mode VARCHAR,              -- full / incremental
+            target_date DATE,          -- 判定基准日期 (上月最后一天)
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            checked BIGINT,            -- 本次检查的股票数
+            status VARCHAR             -- running / finished / failed
+        )
+    """)
+
+
+def last_qc_run(con):
+    """最近一次成功的 QC：(started_at, target_date)，没有时返回 None"""
+    create_qc_table(con)
+    return con.execute(f"""
+        SELECT started_at, target_date FROM {QC_RUNS_TABLE}
+        WHERE status = 'finished' ORDER BY started_at DESC LIMIT 1
+    """).fetchone()
+
+
+def start_qc_run(con, mode, target_date):
+    create_qc_table(con)
+    now = datetime.datetime.now()
+    run_id = now.strftime('%Y%m%d_%H%M%S_%f')
+    con.execute(f"INSERT INTO {QC_RUNS_TABLE} VALUES (?, ?, ?, ?, NULL, NULL, 'running')",
+                [run_id, mode, target_date, now])
+    return run_id
+
+
+def finish_qc_run(con, run_id, checked=None, status='finished'):
+    """status='failed' 的运行不会成为下一次增量 QC 的水位线"""
+    con.execute(f"""
+        UPDATE {QC_RUNS_TABLE} SET status = ?, finished_at = ?, checked = ? WHERE run_id = ?
+    """, [status, datetime.datetime.now(), checked, run_id])
+
+
+def changed_tickers(con, since):
+    """ticker_meta 中 since (减去余量) 之后重算过的股票"""
+    rows = con.execute(f"SELECT ticker FROM {META_TABLE} WHERE updated_at >= ? OR updated_at IS NULL",
+                       [since - WATERMARK_MARGIN]).fetchall()
+    return [r[0] for r in rows]
@@ -0,0 +1,95 @@
+# util/rate_control.py
+# 自适应限速 (AIMD)：成功时缓慢加并发/速率，遇到 429、5xx 或延迟明显升高时成倍削减
+import random
+import threading
+import time
+from contextlib import contextmanager
+from util.yahoo_client import YahooHTTPError
+
+THROTTLE_MARKERS = ('Too Many Requests', 'Rate limited', 'YFRateLimitError', '429')
+
+
+def is_throttled(error):
+    """是否为限流/服务端错误：需要降速，而不是单纯重试"""
+    if isinstance(error, YahooHTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    text = f"{type(error).__name__}: {error}"
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """指数退避 + 全抖动：在 [0, min(cap, base * 2^attempt)] 中随机取值，避免各线程同时重试"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveLimiter:
+    """同时限制并发数与每秒请求数，两者都按 AIMD 调整 (线程安全)
+    - 成功: 并发上限每轮 +1 (每次 +1/limit)，速率 +rate_step
+    - 429 / 5xx: 并发与速率减半，随后 cooldown 秒内不再重复削减
+    - 延迟超过基线 latency_factor 倍: 按 0.7 倍温和削减"""
+
+    def __init__(self, max_concurrency=16, initial_concurrency=4, min_concurrency=1,
+                 rate=3.0, min_rate=0.2, max_rate=20.0, rate_step=0.1,
+                 latency_factor=3.0, cooldown=5.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency)
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.baseline = None         # 成功请求延迟的滑动平均 (秒)
+        self.in_flight = 0
+        self.next_time = time.monotonic()
+        self.last_cut = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return time.monotonic()
+
+    def release(self, started, error=None):
+        latency = time.monotonic() - started
+        with self.cond:
+            self.in_flight -= 1
+            if error is not None and is_throttled(error):
+                self._decrease(0.5)
+            elif error is None:
+                if self.baseline is not None and latency > self.baseline * self.latency_factor:
+                    self._decrease(0.7)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                    self.rate = min(self.max_rate, self.rate + self.rate_step)
+                self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+            self.cond.notify_all()
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_cut < self.cooldown:
+            return
+        self.last_cut = now
+        self.limit = max(self.min_concurrency, self.limit * factor)
+        self.rate = max(self.min_rate, self.rate * factor)
+        print(f"⚠️ 触发限速: 并发降至 {int(self.limit)}，速率降至 {self.rate:.2f}/s")
+
+    @contextmanager
+    def request(self):
+        """with limiter.request(): ... 包住一次网络请求，异常会继续抛出"""
+        started = self.acquire()
+        try:
+            yield
+        except Exception as e:
+            self.release(started, e)
+            raise
+        else:
+            self.release(started)
@@ -0,0 +1,131 @@
+# util/sharding.py
+# 分片下载：每个 worker 按 ticker 哈希取固定的一份股票，写入自己的 staging 文件，
+# 全部结束后由唯一的写入方把 staging 合并进主库
+import glob
+import os
+import zlib
+import pandas as pd
+from util.database_duckdb import (META_TABLE, TABLE_NAME, create_stock_table, refresh_monthly_change,
+                                  refresh_ticker_meta)
+
+STAGING_DIR = os.getenv("STAGING_DIR", "staging")
+BOUNDS_TABLE = "staged_bounds"
+LAST_DATES_FILE = "last_dates.parquet"
+
+
+def shard_config():
+    """从环境变量读取 (分片序号, 分片总数)；k8s Indexed Job 可直接使用 JOB_COMPLETION_INDEX"""
+    count = int(os.getenv("SHARD_COUNT", 1))
+    index = int(os.getenv("SHARD_INDEX", os.getenv("JOB_COMPLETION_INDEX", 0)))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"分片配置错误: SHARD_INDEX={index}, SHARD_COUNT={count}")
+    return index, count
+
+
+def shard_of(ticker, count):
+    """crc32 在不同进程/机器间结果一致 (内置 hash 会随机加盐)"""
+    return zlib.crc32(ticker.encode('utf-8')) % count
+
+
+def shard_tickers(tickers, index, count):
+    if count <= 1:
+        return list(tickers)
+    return [t for t in tickers if shard_of(t, count) == index]
+
+
+def staging_path(index, count, staging_dir=STAGING_DIR):
+    return os.path.join(staging_dir, f"shard_{index:03d}_of_{count:03d}.duckdb")
+
+
+def create_staging_tables(con):
+    """staging 文件里除 stock_data 外，还记录每只股票的替换范围，合并时据此删除主库旧数据"""
+    create_stock_table(con)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {BOUNDS_TABLE} (
+            ticker VARCHAR PRIMARY KEY,
+            since DATE
+        )
+    """)
+
+
+def record_bounds(con, since_map):
+    """登记本批股票的替换范围 (since 为空表示替换全部历史)；在 StockWriter 的事务中调用"""
+    if not since_map:
+        return
+    bounds = pd.DataFrame({
+        'ticker': list(since_map.keys()),
+        'since': pd.to_datetime(list(since_map.values())),
+    })
+    con.register('_staged_bounds_view', bounds)
+    try:
+        con.execute(f"""
+            INSERT OR REPLACE INTO {BOUNDS_TABLE}
+            SELECT ticker, CAST(since AS DATE) FROM _staged_bounds_view
+        """)
+    finally:
+        con.unregister('_staged_bounds_view')
+
+
+def export_last_dates(con, staging_dir=STAGING_DIR):
+    """把主库每只股票的最新日期导出成快照，分片进程做增量时读取，不必打开主库"""
+    os.makedirs(staging_dir, exist_ok=True)
+    path = os.path.join(staging_dir, LAST_DATES_FILE)
+    con.execute(f"""
+        COPY (SELECT ticker, last_date FROM {META_TABLE})
+        TO '{path}' (FORMAT PARQUET)
+    """)
+    return path
+
+
+def load_last_dates(con, staging_dir=STAGING_DIR):
+    """读取 export_last_dates 的快照 {ticker: date}；没有快照时返回 None"""
+    path = os.path.join(staging_dir, LAST_DATES_FILE)
+    if not os.path.exists(path):
+        return None
+    rows = con.execute(f"SELECT ticker, last_date FROM read_parquet('{path}')").fetchall()
+    return {ticker: last_date for ticker, last_date in rows if last_date is not None}
+
+
+def merge_staging(con, staging_dir=STAGING_DIR, remove=True):
+    """把所有 staging 文件在一个事务里合并进主库：先按替换范围删除旧数据，再插入新数据
+    返回合并的文件数；remove=True 时合并成功后删除 staging 文件"""
+    files = sorted(glob.glob(os.path.join(staging_dir, "shard_*.duckdb")))
+    if not files:
+        return 0
+
+    aliases = []
+    try:
+        for i, path in enumerate(files):
+            alias = f"stg{i}"
+            con.execute(f"ATTACH '{path}' AS {alias} (READ_ONLY)")
+            aliases.append(alias)
+
+        con.execute("BEGIN TRANSACTION")
+        try:
+            for alias in aliases:
+                con.execute(f"""
+                    DELETE FROM {TABLE_NAME} USING {alias}.{BOUNDS_TABLE} b
+                    WHERE {TABLE_NAME}.ticker = b.ticker
+                      AND (b.since IS NULL OR {TABLE_NAME}."date" >= b.since)
+                """)
+                con.execute(f'INSERT INTO {TABLE_NAME} BY NAME SELECT * FROM {alias}.{TABLE_NAME} ORDER BY ticker, "date"')
+                # 来源/抓取时间取自分片记录，其余按主库数据重算
+                refresh_ticker_meta(con, f"{alias}.{META_TABLE}")
+                refresh_monthly_change(con, f"{alias}.{BOUNDS_TABLE}")
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+    finally:
+        for alias in aliases:
+            con.execute(f"DETACH {alias}")
+
+    if remove:
+        for path in files:
+            for p in (path, path + ".wal"):
+                if os.path.exists(p):
+                    os.remove(p)
+        snapshot = os.path.join(staging_dir, LAST_DATES_FILE)
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+    return len(files)
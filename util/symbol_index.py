@@ -0,0 +1,134 @@
+# util/symbol_index.py
+# 股票代码索引：ticker -> 市场、是否启用、基本信息。从 Excel 清单 (或 yahoo_data.db) 解析一次后
+# 缓存到本地 JSON，源文件的修改时间/大小变化且内容哈希不同时才重新解析
+import hashlib
+import json
+import os
+import sqlite3
+import pandas as pd
+
+MASTER_XLSX = 'master_symbol_v1.6_2023.03.xlsx'
+LOCAL_DB = 'yahoo_data.db'
+INDEX_PATH = os.path.join('cache', 'symbol_index.json')
+
+# Excel 清单中的工作表序号 -> 市场 (表名取自工作表名)；yahoo_data.db 中直接按表名读取
+XLSX_SHEETS = [2, 1, 3]   # Shanghai_Shenzhen, Snp500_Ru1000, TSX
+DB_TABLES = ['Shanghai_Shenzhen', 'Snp500_Ru1000', 'TSX']
+META_COLUMNS = {'Company': 'company', 'Sector': 'sector', 'star': 'star', '已退市': 'delisted'}
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _entries_from_frame(df, market, entries):
+    """每个工作表/表的第一列是 Yahoo 代码；同一代码出现在多个市场时保留第一个"""
+    tickers = df.iloc[:, 0].astype('string').str.strip()
+    active = (df['currently use'].fillna('').astype(str).str.strip().str.lower() == 'yes'
+              if 'currently use' in df.columns else pd.Series(True, index=df.index))
+    meta = {dst: df[src] for src, dst in META_COLUMNS.items() if src in df.columns}
+    for i, ticker in enumerate(tickers):
+        if pd.isna(ticker) or not ticker or ticker in entries:
+            continue
+        entry = {'market': market, 'active': bool(active.iloc[i])}
+        for key, column in meta.items():
+            value = column.iloc[i]
+            entry[key] = None if pd.isna(value) else (value.item() if hasattr(value, 'item') else value)
+        entries[ticker] = entry
+
+
+def build_entries(source):
+    """解析清单，返回 {ticker: {market, active, company, sector, star, delisted}}"""
+    entries = {}
+    if source.endswith('.xlsx'):
+        with pd.ExcelFile(source) as book:
+            for sheet in XLSX_SHEETS:
+                _entries_from_frame(book.parse(sheet), book.sheet_names[sheet], entries)
+    else:
+        conn = sqlite3.connect(source)
+        try:
+            for table in DB_TABLES:
+                _entries_from_frame(pd.read_sql(f'SELECT * FROM "{table}"', conn), table, entries)
+        finally:
+            conn.close()
+    return entries
+
+
+class SymbolIndex:
+    """O(1) 查询的代码索引，持久化到 index_path"""
+
+    def __init__(self, source=None, index_path=INDEX_PATH):
+        self.source = source or (MASTER_XLSX if os.path.exists(MASTER_XLSX) else LOCAL_DB)
+        self.index_path = index_path
+        self.entries = self._load()
+
+    def _load(self):
+        stat = os.stat(self.source)
+        self.mtime, self.size = stat.st_mtime, stat.st_size
+        cached = None
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = None
+        if cached and cached.get('source') == os.path.abspath(self.source):
+            if cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                return cached['entries']
+            # 修改时间变了但内容没变 (例如重新拷贝)：只更新记录的修改时间
+            digest = _file_hash(self.source)
+            if cached['sha1'] == digest:
+                self._save(cached['entries'], stat, digest)
+                return cached['entries']
+        else:
+            digest = _file_hash(self.source)
+
+        print(f"🔎 重建股票代码索引: {self.source}")
+        entries = build_entries(self.source)
+        self._save(entries, stat, digest)
+        return entries
+
+    def _save(self, entries, stat, digest):
+        os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': os.path.abspath(self.source), 'mtime': stat.st_mtime, 'size': stat.st_size,
+                       'sha1': digest, 'entries': entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def lookup(self, ticker):
+        """返回 {market, active, ...}，找不到时返回 None"""
+        return self.entries.get(ticker)
+
+    def lookup_many(self, tickers):
+        """批量查询，只返回找得到的 {ticker: entry}"""
+        return {t: self.entries[t] for t in tickers if t in self.entries}
+
+    def __contains__(self, ticker):
+        return ticker in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_index = None
+
+
+def get_symbol_index(source=None):
+    """进程内共享的索引；源文件变化后再次调用会自动重建"""
+    global _index
+    if _index is None or (source and _index.source != source) or _stale(_index):
+        _index = SymbolIndex(source)
+    return _index
+
+
+def _stale(index):
+    try:
+        stat = os.stat(index.source)
+    except OSError:
+        return False
+    return index.mtime != stat.st_mtime or index.size != stat.st_size
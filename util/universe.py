@@ -0,0 +1,63 @@
+# util/universe.py
+# 下载范围规划：请求前先剔除未启用 / 已退市的股票，其余按权重打分排序，
+# 限速下先把请求额度花在重要的股票上
+import datetime
+import numpy as np
+import pandas as pd
+
+TICKER_COLUMN = 'Yahoo_adj_Ticker_symbol'
+ACTIVE_COLUMN = 'currently use'
+DELISTED_COLUMN = '已退市'
+INDEX_COLUMNS = ['SnP500', 'Russell 1000']
+
+# 各项得分都归一化到 [0, 1]，再按权重相加
+DEFAULT_WEIGHTS = {'star': 1.0, 'index': 1.0, 'staleness': 2.0}
+STALE_MONTHS = 12    # 超过 12 个月未更新 (或库中没有) 记满分
+
+# 这些取值视为“否”，其余非空值都视为已退市
+NEGATIVE_VALUES = {'', 'no', 'n', 'false', '0', 'none', 'nan'}
+
+
+def _flag(series):
+    """把 yes / 已退市 / 日期 等文本标记转成布尔值"""
+    text = series.fillna('').astype(str).str.strip().str.lower()
+    return ~text.isin(NEGATIVE_VALUES)
+
+
+def load_universe(conn_local, market):
+    """读取市场清单表，返回列为 ticker / active / delisted / star / index_count 的 DataFrame"""
+    df = pd.read_sql(f'SELECT * FROM "{market}"', conn_local)
+    out = pd.DataFrame({'ticker': df[TICKER_COLUMN].astype('string').str.strip()})
+    out['active'] = (df[ACTIVE_COLUMN].fillna('').astype(str).str.strip().str.lower() == 'yes'
+                     if ACTIVE_COLUMN in df.columns else True)
+    out['delisted'] = _flag(df[DELISTED_COLUMN]) if DELISTED_COLUMN in df.columns else False
+    out['star'] = pd.to_numeric(df['star'], errors='coerce').fillna(0) if 'star' in df.columns else 0.0
+    index_cols = [c for c in INDEX_COLUMNS if c in df.columns]
+    out['index_count'] = sum((df[c].fillna('').astype(str).str.strip().str.lower() == 'yes').astype(int)
+                             for c in index_cols) if index_cols else 0
+    out = out[out['ticker'].notna() & (out['ticker'] != '')]
+    return out.drop_duplicates('ticker').reset_index(drop=True)
+
+
+def plan_universe(conn_local, market, last_dates=None, weights=None, today=None):
+    """过滤并排序一个市场的股票，返回按得分降序的 DataFrame (ticker, score, ...)
+    last_dates: {ticker: 库中最新日期}，用于计算多久没更新"""
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    today = pd.Timestamp(today or datetime.date.today())
+    universe = load_universe(conn_local, market)
+
+    keep = universe['active'] & ~universe['delisted']
+    skipped = len(universe) - int(keep.sum())
+    if skipped:
+        print(f"   {market}: 跳过 {skipped} 只未启用/已退市的股票")
+    plan = universe[keep].copy()
+
+    last = pd.to_datetime(plan['ticker'].map(last_dates or {}), errors='coerce')
+    months = ((today - last).dt.days / 30.44).to_numpy(dtype=float)
+    staleness = np.where(np.isnan(months), 1.0, np.clip(months / STALE_MONTHS, 0.0, 1.0))
+
+    index_max = max(len(INDEX_COLUMNS), 1)
+    plan['score'] = (weights['star'] * plan['star'].clip(0, 5) / 5
+                     + weights['index'] * plan['index_count'] / index_max
+                     + weights['staleness'] * staleness)
+    return plan.sort_values(['score', 'ticker'], ascending=[False, True], kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,184 @@
+# util/yahoo_client.py
+# Yahoo chart 接口的共享 HTTP 客户端：一个进程共用一个带连接池的 Session，复用 TCP/TLS 连接
+# 响应原文压缩后缓存在本地磁盘，重跑/重试直接命中缓存；离线模式只读缓存，不发任何请求
+import gzip
+import hashlib
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from util.chart_parser import loads
+
+CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{ticker}"
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, deflate",
+    "Referer": "https://finance.yahoo.com/",
+    "Connection": "keep-alive",
+}
+DEFAULT_POOL_SIZE = 10
+
+# 磁盘缓存配置 (可用环境变量覆盖)
+CACHE_DIR = os.getenv("YAHOO_CACHE_DIR", os.path.join("cache", "chart"))
+CACHE_TTL = int(os.getenv("YAHOO_CACHE_TTL", 12 * 3600))        # 秒，0 表示关闭缓存
+CACHE_MAX_MB = int(os.getenv("YAHOO_CACHE_MAX_MB", 2048))
+OFFLINE = os.getenv("YAHOO_OFFLINE", "0") == "1"                 # 1: 只从缓存读取
+# period2 不早于当前时间减去该值 (秒) 的请求视为"截至最新"，缓存键不含 period2，离线重放不受运行日期影响
+OPEN_END_SLACK = 2 * 24 * 3600
+
+_session = None
+_pool_size = 0
+_lock = threading.Lock()
+
+
+class YahooHTTPError(Exception):
+    """chart 接口返回非 200 状态码"""
+
+    def __init__(self, status_code, ticker=None):
+        super().__init__(f"requests 状态码错误: {status_code}")
+        self.status_code = status_code
+        self.ticker = ticker
+
+
+class CacheMissError(Exception):
+    """离线模式下缓存中没有对应的响应"""
+
+
+class ChartCache:
+    """chart 响应的磁盘缓存：以 (ticker, interval, period1, period2, events) 为键 (截至最新的请求 period2 记为 open)，
+    gzip 压缩保存原始 JSON，超过 TTL 视为过期，总大小超过上限时按最近访问时间淘汰"""
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_mb=CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.size = None   # 首次写入时统计目录大小
+
+    @staticmethod
+    def make_key(ticker, interval, period1, period2, events):
+        end = 'open' if period2 >= time.time() - OPEN_END_SLACK else int(period2)
+        raw = f"{ticker}|{interval}|{int(period1)}|{end}|{events or ''}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json.gz')
+
+    def get(self, key, ignore_ttl=False):
+        path = self._path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if not ignore_ttl and age > self.ttl:
+                return None
+            with gzip.open(path, 'rb') as f:
+                raw = f.read()
+            # 只更新访问时间，淘汰时据此判断冷热；mtime 保留写入时间用于 TTL
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return raw
+        except (OSError, EOFError):
+            return None
+
+    def put(self, key, raw):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self._entries())
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.json.gz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_atime, stat.st_size
+
+    def _evict(self):
+        """淘汰最久未访问的文件，直到总大小降到上限的 90%"""
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(e[2] for e in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+_cache = ChartCache() if CACHE_TTL > 0 or OFFLINE else None
+
+
+def configure_cache(cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_mb=CACHE_MAX_MB, offline=None):
+    """重新设置缓存目录/TTL/大小上限；ttl=0 且非离线时关闭缓存"""
+    global _cache, OFFLINE
+    if offline is not None:
+        OFFLINE = offline
+    _cache = ChartCache(cache_dir, ttl, max_mb) if ttl > 0 or OFFLINE else None
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE):
+    """按并发线程数设置连接池大小；池子只会扩大，请求的大小不超过当前池时什么都不做 (已建立的连接继续复用)
+    扩大时换上新的 adapter 并关闭旧的，旧池中的 keep-alive 连接随之断开，之后的请求在新池中重新建立连接"""
+    global _session, _pool_size
+    with _lock:
+        if _session is not None and pool_size <= _pool_size:
+            return _session
+        session = _session or requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        old_adapters = {id(a): a for a in (session.adapters.get("https://"), session.adapters.get("http://")) if a}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        for old in old_adapters.values():
+            old.close()
+        _session, _pool_size = session, pool_size
+        return session
+
+
+def get_session():
+    """返回进程内共享的 Session (首次调用时按默认池大小创建)"""
+    return _session or configure_session()
+
+
+def fetch_chart_raw(ticker, period1, period2, interval='1mo', events=None, timeout=15):
+    """请求 chart 接口，返回原始响应字节；非 200 抛出 YahooHTTPError
+    先查磁盘缓存，离线模式下缓存未命中抛出 CacheMissError"""
+    key = ChartCache.make_key(ticker, interval, period1, period2, events) if _cache else None
+    if _cache:
+        raw = _cache.get(key, ignore_ttl=OFFLINE)
+        if raw is not None:
+            return raw
+    if OFFLINE:
+        raise CacheMissError(f"离线模式缓存未命中: {ticker} {interval} {period1}-{period2}")
+
+    params = {"period1": int(period1), "period2": int(period2), "interval": interval}
+    if events:
+        params["events"] = events
+    response = get_session().get(CHART_URL.format(ticker=ticker), params=params, timeout=timeout)
+    if response.status_code != 200:
+        raise YahooHTTPError(response.status_code, ticker)
+    if _cache:
+        _cache.put(key, response.content)
+    return response.content
+
+
+def fetch_chart(ticker, period1, period2, interval='1mo', events=None, timeout=15):
+    """请求 chart 接口并解析 JSON"""
+    return loads(fetch_chart_raw(ticker, period1, period2, interval, events, timeout))